@@ -25,35 +25,18 @@
 # **************************************************************************
 
 import os
-import pickle
+import sys
+import json
+import time
+import hashlib
+import importlib
 import subprocess
 import random
 from collections import OrderedDict
 
 import pyworkflow.utils as pwutils
 from pyworkflow.project import Manager
-from pyworkflow.object import Pointer
-from pyworkflow.em.protocol import (ProtImportMovies, ProtMonitorSummary,
-                                    ProtUnionSet, ProtMonitor2dStreamer,
-                                    ProtSubSet, ProtExtractCoords)
-
-try:  # Xmipp plugin is mandatory to run this workflow
-    from xmipp3.protocols import (XmippProtOFAlignment, XmippProtMovieGain,
-                                  XmippProtMovieMaxShift, XmippProtCTFMicrographs,
-                                  XmippProtMovieCorr, XmippProtCTFConsensus,
-                                  XmippProtPreprocessMicrographs, XmippProtParticleBoxsize,
-                                  XmippProtParticlePicking, XmippParticlePickingAutomatic,
-                                  XmippProtConsensusPicking, XmippProtCL2D,
-                                  XmippProtExtractParticles, XmippProtTriggerData,
-                                  XmippProtEliminateEmptyParticles,
-                                  XmippProtScreenParticles,
-                                  XmippProtReconstructSignificant, XmippProtRansac,
-                                  XmippProtAlignVolume, XmippProtReconstructSwarm,
-                                  XmippProtStrGpuCrrSimple, XmippProtGpuCrrCL2D,
-                                  XmippProtCropResizeVolumes, XmippProtEliminateEmptyClasses,
-                                  XmippProtDeepMicrographScreen)
-except Exception as exc:
-     pwutils.pluginNotFound('xmipp', errorMsg=exc, doRaise=True)
+from pyworkflow.object import Pointer, String
 
 # Protocols from plugins to import (some are optional, according to config params)
 protPlugins = {'ProtMotionCorr': 'motioncorr.protocols',
@@ -73,9 +56,57 @@ protPlugins = {'ProtMotionCorr': 'motioncorr.protocols',
                'ProtCryoSparcInitialModel': 'cryosparc2.protocols'}
 
 from constants import *
+from project_utils import ProjectBatch, LabelStore
 
 
 def preprocessWorkflow(configDict):
+    manager = Manager()
+    project = manager.createProject(configDict.get(PROJECT_NAME),
+                                    location=configDict.get(PROJECTS_PATH))
+
+    # All protocols are registered in a single database transaction,
+    #  discarded if anything fails
+    labels = []  # (protId, labelName, color)
+    with ProjectBatch(project, 'Registering protocols'):
+        registerWorkflow(project, configDict, labels)
+
+    # and their labels only once they are stored
+    labelStore = LabelStore(project.getPath())
+    labelStore.add(labels)
+    labelStore.close()
+
+    printImportReport()
+    return project
+
+
+def registerWorkflow(project, configDict, labels):
+    # Protocols are imported here, only when the workflow is built
+    t0 = time.time()
+    from pyworkflow.em.protocol import (ProtImportMovies, ProtMonitorSummary,
+                                        ProtUnionSet, ProtMonitor2dStreamer,
+                                        ProtSubSet, ProtExtractCoords)
+
+    importTimes['pyworkflow.em.protocol'] = time.time() - t0
+
+    t0 = time.time()
+    try:  # Xmipp plugin is mandatory to run this workflow
+        from xmipp3.protocols import (XmippProtOFAlignment, XmippProtMovieGain,
+                                      XmippProtMovieMaxShift, XmippProtCTFMicrographs,
+                                      XmippProtMovieCorr, XmippProtCTFConsensus,
+                                      XmippProtPreprocessMicrographs, XmippProtParticleBoxsize,
+                                      XmippProtParticlePicking, XmippParticlePickingAutomatic,
+                                      XmippProtConsensusPicking, XmippProtCL2D,
+                                      XmippProtExtractParticles, XmippProtTriggerData,
+                                      XmippProtEliminateEmptyParticles,
+                                      XmippProtScreenParticles,
+                                      XmippProtReconstructSignificant, XmippProtRansac,
+                                      XmippProtAlignVolume, XmippProtReconstructSwarm,
+                                      XmippProtStrGpuCrrSimple, XmippProtGpuCrrCL2D,
+                                      XmippProtCropResizeVolumes, XmippProtEliminateEmptyClasses,
+                                      XmippProtDeepMicrographScreen)
+    except Exception as exc:
+        pwutils.pluginNotFound('xmipp', errorMsg=exc, doRaise=True)
+    importTimes['xmipp3.protocols'] = time.time() - t0
 
     print("Final parameters to be used in the workflow:")
     for k, v in sorted(configDict.iteritems()):
@@ -85,11 +116,6 @@ def preprocessWorkflow(configDict):
     def get(var, default=None):
         return configDict.get(var, default)
 
-    manager = Manager()
-    project = manager.createProject(get(PROJECT_NAME),
-                                    location=get(PROJECTS_PATH))
-
-
     # Total available CPUs to be used in very demanding computations
     numCpus = getCpus(get(NUM_CPU, -1))
 
@@ -135,10 +161,13 @@ def preprocessWorkflow(configDict):
     # we will fill a list with all protocols
     # to be included in the summary report
     summaryList = []
-    def _registerProt(prot, label='', toSummary=False, color=''):
+    def _registerProt(prot, label='', toSummary=False, color='', priority=None):
+        priority = priority or labelPriorities.get(label)
+        if priority:  # stored in the project to be read by the scheduler
+            setattr(prot, PRIORITY_ATTR, String(priority))
         project.saveProtocol(prot)
         if label != '':
-            applyLabel(prot, label, color)
+            applyLabel(prot, label, color, labels)
         if toSummary:
             summaryList.append(prot)
 
@@ -157,8 +186,7 @@ def preprocessWorkflow(configDict):
 
     # ***********   MOVIES   ***********************************************
     doDose = True if get(DOSEF, 0) > 0 else False
-    gainGlob = pwutils.glob(os.path.join(get(DEPOSITION_DIR),
-                                         get(GAIN_PAT, 'noGain')))
+    gainGlob = findGains(configDict)
     if len(gainGlob) >= 1:
         gainFn = gainGlob[0]
     else:
@@ -782,7 +810,8 @@ def preprocessWorkflow(configDict):
                                             # doFourier=True,  # incompatible with sampling rate option
                                             resizeSamplingRate=finalSamp)
             setExtendedInput(protVOL3D.inputVolumes, protSWARM, initVolOut)
-            _registerProt(protVOL3D, 'useful_OUTPUTs', color='#00ff00')
+            _registerProt(protVOL3D, 'useful_OUTPUTs', color='#00ff00',
+                          priority=PRIORITY_3D)
             vol3Dout = 'outputVol'
 
             # # --------- EXTRACT (almost) FULL SIZE PART ------------------
@@ -826,7 +855,8 @@ def preprocessWorkflow(configDict):
             setExtendedInput(protExtract3D.inputMicrographs,
                              protPreMics0, 'outputMicrographs')
             setExtendedInput(protExtract3D.ctfRelations, protCTFs, 'outputCTF')
-            _registerProt(protExtract3D, 'useful_OUTPUTs', color='#00ff00')
+            _registerProt(protExtract3D, 'useful_OUTPUTs', color='#00ff00',
+                          priority=PRIORITY_3D)
         else:
             protVOL3D = protSWARM
             vol3Dout = initVolOut
@@ -930,7 +960,8 @@ def preprocessWorkflow(configDict):
                                            gpuList=get(GL2D_GPU))
             setExtendedInput(protGL2D.inputRefs, protCl2Av2, 'outputAverages')
             setExtendedInput(protGL2D.inputParticles, protSCRor, 'outputParticles')
-            _registerProt(protGL2D, 'useful_OUTPUTs', color='#00ff00')
+            _registerProt(protGL2D, 'useful_OUTPUTs', color='#00ff00',
+                          priority=PRIORITY_2D)
         else:
             # --------- ADDING 2D CLASSIFIERS -------------------------
             clProt2Streaming = protCL2 if get(RELION_2D) else classifiers[0]
@@ -952,10 +983,30 @@ def preprocessWorkflow(configDict):
     protMonitor.inputProtocols.set(summaryList)
     _registerProt(protMonitor, 'monitor')
 
-    # Saving the labels and colors:
-    with open(os.path.join(get(PROJECTS_PATH), get(PROJECT_NAME), 'labels.pkl'),
-              'w') as f:
-        pickle.dump([labelsDict, colorsDict], f)
+
+def findGains(configDict):
+    return pwutils.glob(os.path.join(configDict.get(DEPOSITION_DIR),
+                                     configDict.get(GAIN_PAT, 'noGain')))
+
+
+def updateGain(project, configDict):
+    """ Set the gain in the workflow already built if it has changed in the
+        deposition folder (i.e. if it was linked while building it).
+    """
+    gainGlob = findGains(configDict)
+    gainFn = gainGlob[0] if gainGlob else ''
+    for prot in project.getRuns():
+        if (prot.getClassName() == 'ProtImportMovies' and
+                prot.gainFile.get() != gainFn):
+            print(" > Gain file changed while building: '%s'" % gainFn)
+            prot.gainFile.set(gainFn)
+        elif (prot.getClassName() == 'XmippProtMovieGain' and
+                prot.normalizeGain.get() != bool(gainFn)):
+            prot.estimateOrientation.set(bool(gainFn))
+            prot.normalizeGain.set(bool(gainFn))
+        else:
+            continue
+        project.saveProtocol(prot)
 
 
 def getEvenPartSize(partSize):
@@ -966,13 +1017,104 @@ def getEvenPartSize(partSize):
 
 
 def importPlugin(protocol):
+    """ Return the protocol class from its plugin, as resolved in the plugin
+        registry (imported only once per run).
+    """
     if protocol not in protPlugins:
         raise Exception("'%s' protocol from plugin not found. Please, "
                         "include it at the available protocol list.\n"
                         "(at the beginning of %s)"
                         % (protocol, os.path.abspath(__file__)))
-    return pwutils.importFromPlugin(protPlugins[protocol], protocol,
-                                    doRaise=True)
+    if protocol not in pluginClasses:
+        entry = getPluginRegistry()['protocols'][protocol]
+        t0 = time.time()
+        try:  # straight to the module defining it
+            module = importlib.import_module(entry['module'])
+            pluginClasses[protocol] = getattr(module, protocol)
+        except (ImportError, AttributeError):
+            # not available or plugins changed since the registry was built
+            pluginClasses[protocol] = pwutils.importFromPlugin(
+                protPlugins[protocol], protocol, doRaise=True)
+        # several protocols per module, the first one pays the import
+        plugin = protPlugins[protocol]
+        importTimes[plugin] = importTimes.get(plugin, 0) + time.time() - t0
+    return pluginClasses[protocol]
+
+
+def getRegistryKey():
+    """ The registry is valid for a Scipion installation and protPlugins. """
+    return hashlib.md5(repr((os.environ.get('SCIPION_HOME'),
+                             sorted(protPlugins.items())))).hexdigest()
+
+
+def buildPluginRegistry():
+    """ Import every protocol in protPlugins to know the module where it is
+        defined and whether it is available, and save it in PLUGIN_REGISTRY.
+    """
+    protocols = {}
+    for protocol, plugin in sorted(protPlugins.items()):
+        t0 = time.time()
+        try:
+            cls = pwutils.importFromPlugin(plugin, protocol, doRaise=True)
+            entry = {'module': cls.__module__, 'available': True}
+        except Exception as exc:
+            entry = {'module': plugin, 'available': False, 'error': str(exc)}
+        entry['seconds'] = time.time() - t0
+        protocols[protocol] = entry
+
+    registry = {'key': getRegistryKey(), 'protocols': protocols}
+    try:  # written apart and renamed to never leave a broken registry
+        pwutils.makePath(os.path.dirname(PLUGIN_REGISTRY))
+        with open(PLUGIN_REGISTRY + '.tmp', 'w') as f:
+            json.dump(registry, f, indent=2, sort_keys=True)
+        os.rename(PLUGIN_REGISTRY + '.tmp', PLUGIN_REGISTRY)
+    except (IOError, OSError) as exc:
+        print("Plugin registry not saved: %s" % exc)
+    return registry
+
+
+def getPluginRegistry():
+    """ The plugin registry, built only if missing or outdated. """
+    global pluginRegistry
+    if pluginRegistry is None:
+        try:
+            with open(PLUGIN_REGISTRY) as f:
+                pluginRegistry = json.load(f)
+        except (IOError, ValueError):
+            pluginRegistry = {}
+        if (pluginRegistry.get('key') != getRegistryKey() or
+                set(pluginRegistry['protocols']) != set(protPlugins)):
+            print("Building the plugin registry: %s" % PLUGIN_REGISTRY)
+            pluginRegistry = buildPluginRegistry()
+    return pluginRegistry
+
+
+def printImportReport():
+    """ Time spent importing protocols in this run, and importing every
+        plugin when the registry was built.
+    """
+    print("\nImport times (this run):")
+    for name, seconds in sorted(importTimes.items(), key=lambda x: -x[1]):
+        print("  %6.2f s  %s" % (seconds, name))
+    print("  %6.2f s  TOTAL" % sum(importTimes.values()))
+
+    if pluginRegistry:
+        print("\nPlugin registry (%s):" % PLUGIN_REGISTRY)
+        for protocol, entry in sorted(pluginRegistry['protocols'].items(),
+                                      key=lambda x: -x[1]['seconds']):
+            print("  %6.2f s  %-26s %s" % (entry['seconds'], protocol,
+                                          entry['module'] if entry['available']
+                                          else 'NOT AVAILABLE'))
+    print('')
+
+
+# Resolved plugins, see getPluginRegistry()
+PLUGIN_REGISTRY = os.path.join(os.environ.get('SCIPION_USER_DATA',
+                                              '/tmp/scipion'),
+                               'acquisition_plugins.json')
+pluginRegistry = None
+pluginClasses = {}  # protocol name: class
+importTimes = OrderedDict()  # module: seconds importing it
 
 labelsDict = OrderedDict()  # key: labelName ; value: [prot1, prot2, prot3...])
 colorsDict = OrderedDict()  # key: labelName ; value: colorRGB
@@ -980,7 +1122,7 @@ random.seed(6)
 colorsDef = ["#e57373", "#4fc3f7", "#81c784", "#ff8a65", "#9575cd",
              "#a1887f", "#ffd54f", "#dce775", "#4db6ac"]
 
-def applyLabel(prot, labelName, color=''):
+def applyLabel(prot, labelName, color='', labels=None):
     if all(l != labelName for l in labelsDict.keys()):
         if color == '':
             if len(colorsDict) < 9:
@@ -992,6 +1134,8 @@ def applyLabel(prot, labelName, color=''):
         labelsDict.update({labelName: [prot.getObjId()]})
     else:
         labelsDict[labelName].append(prot.getObjId())
+    if labels is not None:
+        labels.append((prot.getObjId(), labelName, colorsDict[labelName]))
 
 def getCpus(cpusDefault):
     if cpusDefault > 0:
@@ -1003,3 +1147,13 @@ def getCpus(cpusDefault):
         except:
             numCpus = 8
     return numCpus
+
+
+if __name__ == '__main__':
+    # scipion python acquisition_workflow.py [--rebuild]
+    #   to (re)build the plugin registry and print the import times
+    if '--rebuild' in sys.argv[1:]:
+        pluginRegistry = buildPluginRegistry()
+    else:
+        getPluginRegistry()
+    printImportReport()
@@ -0,0 +1,414 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:     em-facilities contributors (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+"""
+Ramp load test of the streaming pipeline.
+
+Movies are published (by means of simulate_acquisition.py) at a rising
+arrival rate, holding every rate for a while. Meanwhile, the number of
+items processed by every streaming stage is polled to follow how far it
+lags behind the arrivals. A stage is saturated at a certain rate when its
+lag keeps growing during that step, thus the report gives the highest
+sustainable rate (movies per hour) and the stage that limits it.
+
+The stages can be polled from a Scipion project (--project) or from a
+local stand-in backend that models every stage by its throughput, so the
+harness can run without Scipion protocols, GPUs nor real data.
+"""
+
+import sys, os
+import json
+import time
+import argparse
+import threading
+import traceback
+from collections import OrderedDict
+from glob import glob
+
+import pyworkflow.utils as pwutils
+
+import simulate_acquisition as simulator
+
+
+# Streaming stages to follow: (name, protocol class names, output names).
+# The size of a stage is the one of the first protocol (in creation order)
+# of any of those classes, that is the main branch of acquisition_workflow.
+STAGES = [('import', ['ProtImportMovies'], ['outputMovies']),
+          ('motion', ['ProtMotionCorr', 'XmippProtMovieCorr'],
+           ['outputMicrographs', 'outputMicrographsDoseWeighted']),
+          ('ctf', ['ProtGctf', 'XmippProtCTFMicrographs', 'ProtCTFFind'],
+           ['outputCTF']),
+          ('extraction', ['XmippProtExtractParticles'], ['outputParticles'])]
+
+# Default throughput (movies per hour) of every stage in the local backend
+LOCAL_STAGE_RATES = OrderedDict([('import', 36000),
+                                 ('motion', 600),
+                                 ('ctf', 900),
+                                 ('extraction', 1200)])
+
+DEFAULT_RATES = [60, 120, 240, 480, 960]
+PARTICLE_SIZE = 64  # of the synthetic movies, in pixels
+
+# A step is only valid if the movies arrived at least at this fraction of
+# the target rate (i.e. the publishing did not keep up)
+MIN_ARRIVAL_FRACTION = 0.5
+
+
+class LocalProjectBackend(object):
+    """ Stand-in of a streaming project. The import stage counts the movies
+        present in the deposition folder and every stage processes the
+        items of the previous one at its own throughput (movies/hour).
+    """
+    def __init__(self, depositionPattern, stageRates=LOCAL_STAGE_RATES):
+        self.depositionPattern = depositionPattern
+        self.stageRates = stageRates
+        self.counts = OrderedDict((stage, 0.) for stage in stageRates)
+        self.lastTime = None
+
+    def getStageSizes(self):
+        now = time.time()
+        dt = 0 if self.lastTime is None else now - self.lastTime
+        self.lastTime = now
+
+        available = len(glob(self.depositionPattern))
+        for stage, rate in self.stageRates.items():
+            done = min(available, self.counts[stage] + rate * dt / 3600.)
+            self.counts[stage] = done
+            available = done
+        return OrderedDict((k, int(v)) for k, v in self.counts.items())
+
+
+class ScipionProjectBackend(object):
+    """ Poll the output sets of a Scipion project. """
+    def __init__(self, projName):
+        from pyworkflow.project import Manager, Project
+
+        manager = Manager()
+        if not manager.hasProject(projName):
+            usage("There is no project with this name: %s"
+                  % pwutils.red(projName))
+        try:
+            projectPath = os.readlink(manager.getProjectPath(projName))
+        except:
+            projectPath = manager.getProjectPath(projName)
+        self.project = Project(projectPath)
+        self.project.load()
+
+    def _getOutputSize(self, prot, outputNames):
+        for outName in outputNames:
+            outSet = getattr(prot, outName, None)
+            if outSet is None:
+                continue
+            if outName == 'outputParticles':
+                # extracted micrographs, to compare them with the movies
+                return len(outSet.aggregate(['COUNT'], '_micId', ['_micId']))
+            return outSet.getSize()
+        return 0
+
+    def getStageSizes(self):
+        sizes = OrderedDict()
+        runs = self.project.getRuns(refresh=True)
+        for stage, classNames, outputNames in STAGES:
+            for prot in runs:
+                if prot.getClassName() in classNames:
+                    sizes[stage] = self._getOutputSize(prot, outputNames)
+                    break
+        return sizes
+
+
+def usage(error):
+    print("""
+    ERROR: %s
+
+    Usage: benchmark_acquisition.py INPUT_PATTERN OUTPUT_FOLDER [options]
+        INPUT_PATTERN: input movies (or name template with --synthetic).
+        OUTPUT_FOLDER: where the movies are deposited.
+
+        Options:
+        --rates R1 R2 ...: arrival rates to ramp, in movies/hour
+                           (default: %s).
+        --step-duration SECONDS: time holding every rate (default: 600).
+        --poll SECONDS: polling interval of the stages (default: 10).
+        --tolerance FRACTION: lag growth, relative to the arrival rate,
+                              to consider a stage saturated (default: 0.05).
+        --project NAME: poll the stages of this Scipion project.
+                        If not, a local stand-in backend is used.
+        --stage-rates STAGE=RATE ...: throughput of the local stages in
+                                      movies/hour (default: %s).
+        --synthetic: generate the movies instead of linking INPUT_PATTERN
+                     (see --size and --frames).
+        --size X Y, --frames N: synthetic movies geometry (X and Y
+                                larger than %d).
+        --report FILE: save the report and all samples in json.
+    """ % (error, ' '.join(str(r) for r in DEFAULT_RATES),
+           ' '.join('%s=%s' % kv for kv in LOCAL_STAGE_RATES.items()),
+           PARTICLE_SIZE))
+    sys.exit(1)
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('inputPattern')
+    parser.add_argument('outputDir')
+    parser.add_argument('--rates', type=float, nargs='+',
+                        default=DEFAULT_RATES)
+    parser.add_argument('--step-duration', dest='stepDuration', type=float,
+                        default=600)
+    parser.add_argument('--poll', type=float, default=10)
+    parser.add_argument('--tolerance', type=float, default=0.05)
+    parser.add_argument('--project', default=None)
+    parser.add_argument('--stage-rates', dest='stageRates', nargs='+',
+                        default=[])
+    parser.add_argument('--synthetic', action='store_true')
+    parser.add_argument('--size', type=int, nargs=2, default=[4096, 4096])
+    parser.add_argument('--frames', type=int, default=40)
+    parser.add_argument('--report', default=None)
+
+    try:
+        args = parser.parse_args(argv)
+    except SystemExit:
+        usage("Incorrect input parameters")
+
+    if min(args.rates) <= 0 or args.stepDuration <= 0 or args.poll <= 0:
+        usage("Rates, step duration and polling must be positive numbers.")
+    if args.synthetic and (min(args.size) <= PARTICLE_SIZE or args.frames < 1):
+        usage("Wrong size or frames for synthetic movies.")
+
+    stageRates = OrderedDict(LOCAL_STAGE_RATES)
+    for item in args.stageRates:
+        try:
+            stage, rate = item.split('=')
+            if stage not in stageRates:
+                raise ValueError
+            stageRates[stage] = float(rate)
+        except ValueError:
+            usage("Wrong stage rate '%s'. Stages are: %s"
+                  % (item, ', '.join(stageRates)))
+    args.stageRates = stageRates
+    return args
+
+
+def getRampSchedule(names, rates, stepDuration):
+    """ Return a list of (name, offset, step) with the arrivals of every
+        step of the ramp. It stops before if there are no more names.
+    """
+    schedule = []
+    names = list(names)
+    stepStart = 0.
+    for step, rate in enumerate(rates):
+        gap = 3600. / rate
+        offset = stepStart
+        while offset < stepStart + stepDuration and names:
+            schedule.append((names.pop(0), offset, step))
+            offset += gap
+        stepStart += stepDuration
+    return schedule
+
+
+def analyzeStep(rate, samples, tolerance, expectedRate=None):
+    """ Compare the first and last samples of a step to get, for every
+        stage, the lag growth and the processing rate (movies/hour).
+        The step is not valid if the movies arrived far slower than
+        expectedRate (the rate, if not given).
+    """
+    first, last = samples[0], samples[-1]
+    hours = (last['time'] - first['time']) / 3600.
+    if hours <= 0:
+        return None
+
+    arrivalRate = (last['published'] - first['published']) / hours
+    stages = OrderedDict()
+    for stage in last['sizes']:
+        lag0 = first['published'] - first['sizes'].get(stage, 0)
+        lag1 = last['published'] - last['sizes'].get(stage, 0)
+        growth = (lag1 - lag0) / hours
+        processed = (last['sizes'][stage] - first['sizes'].get(stage, 0))
+        stages[stage] = {'lag': lag1,
+                         'lagGrowth': growth,
+                         'throughput': processed / hours,
+                         'saturated': growth > tolerance * rate and lag1 > 1}
+    expectedRate = rate if expectedRate is None else expectedRate
+    return {'rate': rate,
+            'arrivalRate': arrivalRate,
+            'valid': arrivalRate >= MIN_ARRIVAL_FRACTION * expectedRate,
+            'stages': stages,
+            'saturated': any(s['saturated'] for s in stages.values())}
+
+
+def printReport(steps):
+    """ Print the lag of every stage at the end of every step (a '*' marks
+        the saturated ones) and return the sustainable rate and bottleneck.
+    """
+    print("\n  ---   Ramp load test report   ---\n")
+    stages = list(steps[0]['stages']) if steps else []
+    print("%10s %10s %s" % ('target/h', 'arrived/h',
+                            ''.join('%14s' % s for s in stages)))
+    for step in steps:
+        lags = ''.join('%13d%s' % (step['stages'][s]['lag'],
+                                   '*' if step['stages'][s]['saturated']
+                                   else ' ')
+                       for s in stages)
+        print("%10.0f %10.0f%s%s" % (step['rate'], step['arrivalRate'],
+                                     ' ' if step['valid'] else '!', lags))
+
+    invalid = [s for s in steps if not s['valid']]
+    if invalid:
+        print("\n Movies published far slower than %s movies/hour ('!'), "
+              "the ramp is not valid from there on." % invalid[0]['rate'])
+        steps = steps[:steps.index(invalid[0])]
+
+    sustainable = 0
+    for step in steps:
+        if step['saturated']:
+            break
+        sustainable = step['rate']
+
+    bottleneck = None
+    saturatedSteps = [s for s in steps if s['saturated']]
+    if saturatedSteps:
+        stepStages = saturatedSteps[0]['stages']
+        bottleneck = [s for s in stepStages if stepStages[s]['saturated']][0]
+        capacity = max(s['stages'][bottleneck]['throughput']
+                       for s in saturatedSteps)
+        print("\n Bottleneck stage: %s (~%.0f movies/hour)"
+              % (bottleneck, capacity))
+    elif steps:
+        print("\n No stage saturated, try higher rates.")
+
+    if sustainable:
+        print(" Sustainable rate: %s movies/hour\n" % sustainable)
+    elif steps:
+        print(" Sustainable rate: below %s movies/hour\n" % steps[0]['rate'])
+    return sustainable, bottleneck
+
+
+def main(argv):
+    args = parseArgs(argv)
+
+    if args.synthetic:
+        nMovies = sum(int(r * args.stepDuration / 3600.) + 1
+                      for r in args.rates)
+        names = simulator.getSyntheticNames(args.inputPattern, nMovies)
+        generator = simulator.SyntheticMovies(args.size, args.frames,
+                                              particleSize=PARTICLE_SIZE)
+        publish = generator.publish
+    else:
+        names = sorted(glob(pwutils.expandPattern(args.inputPattern)))
+        publish = simulator.publishFile
+
+    schedule = getRampSchedule(names, args.rates, args.stepDuration)
+    if not schedule:
+        usage("No input files found.")
+    lastStep = schedule[-1][2]
+    if lastStep < len(args.rates) - 1:
+        print("Not enough input files, the ramp stops at %s movies/hour."
+              % args.rates[lastStep])
+    rates = args.rates[:lastStep + 1]
+    # the last step may not have enough movies for the whole step
+    expectedRates = [min(rate, 3600. * [s for _, _, s in schedule].count(step)
+                                / args.stepDuration)
+                     for step, rate in enumerate(rates)]
+
+    print("Cleaning output directory: ", args.outputDir)
+    pwutils.cleanPath(args.outputDir)
+    pwutils.makePath(args.outputDir)
+
+    if args.project:
+        backend = ScipionProjectBackend(args.project)
+    else:
+        ext = os.path.splitext(names[0])[1]
+        backend = LocalProjectBackend(os.path.join(args.outputDir, '*' + ext),
+                                      args.stageRates)
+
+    published = [0]
+    failure = []  # (exception, traceback) of the publishing thread
+
+    def _publish(f, outputDir, **kwargs):
+        publish(f, outputDir, **kwargs)
+        published[0] += 1
+
+    def _runRamp():
+        startTime = time.time()
+        try:
+            for f, offset, step in schedule:
+                wait = startTime + offset - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                _publish(f, args.outputDir)
+        except Exception as exc:
+            failure.append((exc, traceback.format_exc()))
+
+    stepSamples = [[] for _ in rates]
+    thread = threading.Thread(target=_runRamp)
+    thread.daemon = True
+    startTime = time.time()
+    thread.start()
+
+    try:
+        for step, rate in enumerate(rates):
+            print("\n Step %d: %s movies/hour" % (step + 1, rate))
+            stepEnd = startTime + (step + 1) * args.stepDuration
+            while True:
+                sample = {'time': time.time(),
+                          'published': published[0],
+                          'sizes': backend.getStageSizes()}
+                stepSamples[step].append(sample)
+                print("   %6ds published: %5d   %s"
+                      % (sample['time'] - startTime, sample['published'],
+                         '  '.join('%s: %d' % kv
+                                   for kv in sample['sizes'].items())))
+                if failure:
+                    print("\nPublishing failed, no report is given.\n%s"
+                          % failure[0][1])
+                    raise failure[0][0]
+                if sample['time'] >= stepEnd:
+                    break
+                time.sleep(min(args.poll, max(stepEnd - time.time(), 0)))
+    except KeyboardInterrupt:
+        print("\nInterrupted, reporting the finished steps.")
+
+    steps = [analyzeStep(rate, samples, args.tolerance, expectedRate)
+             for rate, samples, expectedRate
+             in zip(rates, stepSamples, expectedRates)
+             if len(samples) > 1]
+    steps = [s for s in steps if s is not None]
+    sustainable, bottleneck = printReport(steps)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'backend': args.project or 'local',
+                       'sustainableRate': sustainable,
+                       'bottleneck': bottleneck,
+                       'steps': steps,
+                       'samples': stepSamples}, f, indent=2)
+        print("Report saved at %s" % args.report)
+
+    if any(not s['valid'] for s in steps):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
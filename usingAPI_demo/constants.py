@@ -24,6 +24,8 @@
 # *
 # **************************************************************************
 
+from collections import OrderedDict
+
 #   ---   CONSTANTS   ---   #
 WINDOWS_TITLE = 'WINDOWS_TITLE'
 VIEW_WIZARD = 'wizardview'
@@ -36,13 +38,20 @@ PATTERN = 'SCIPION_ACQUISITION_PATTERN'
 GAIN_PAT = 'GAIN_PAT'
 SIMULATION = 'SIMULATION'
 RAWDATA_SIM = 'RAWDATA_SIM'
+SIM_TRANSFER = 'SIM_TRANSFER'
 AMP_CONTR = 'AMP_CONTR'
 SPH_AB = 'SPH_AB'
 VOL_KV = 'VOL_KV'
 SAMPLING = 'SAMPLING'
 TIMEOUT = 'TIMEOUT'
+DATA_TIMEOUT = 'DATA_TIMEOUT'
 INV_CONTR = 'INV_CONTR'
 NUM_CPU = 'NUM_CPU'
+PREFLIGHT = 'PREFLIGHT'
+PREFLIGHT_MB = 'PREFLIGHT_MB'
+MOVIES_PER_HOUR = 'MOVIES_PER_HOUR'
+FRAMES_PER_MOVIE = 'FRAMES_PER_MOVIE'
+FRAME_MB = 'FRAME_MB'
 
 # Form fields
 PROJECT_NAME = "PROJECT_NAME"
@@ -193,6 +202,7 @@ formatConfParameters = [(SIMULATION, bool, False),
                         (VOL_KV, float, 'Mandatory'),
                         (SAMPLING, float, 'Mandatory'),
                         (TIMEOUT, 'splitTimesFloat', 60),
+                        (DATA_TIMEOUT, 'splitTimesFloat', 300),
                         (INV_CONTR, bool, 'Mandatory'),
                         (NUM_CPU, int, -1),
                         (MICS2PICK, int, 10),
@@ -204,4 +214,37 @@ formatConfParameters = [(SIMULATION, bool, False),
                         (PARTS2CLASS, int, 5000),
                         (WAIT2PICK, bool, False),
                         (OPTICAL_FLOW, bool, False),
+                        (PREFLIGHT, bool, True),
+                        (PREFLIGHT_MB, int, 256),
+                        (MOVIES_PER_HOUR, int, 200),
+                        (FRAMES_PER_MOVIE, int, 40),
+                        (FRAME_MB, 'splitTimesFloat', 16),
+                        (SIM_TRANSFER, str, 'link'),
                         ]
+
+# The same indexed by name: {name: (cast, default, isMandatory)}
+confSchema = OrderedDict((name, (cast, default, default == 'Mandatory'))
+                         for name, cast, default in formatConfParameters)
+
+
+#   ---   PRIORITY CLASSES   ---
+# Every protocol of the workflow carries one of them (in the attribute below)
+#  to let the scheduler pause the lower ones when the preprocessing lags behind
+PRIORITY_ATTR = '_priorityClass'
+PRIORITY_PREPROCESSING = 'preprocessing'
+PRIORITY_PICKING = 'picking'
+PRIORITY_2D = '2D'
+PRIORITY_3D = '3D'
+PRIORITY_CLASSES = [PRIORITY_PREPROCESSING, PRIORITY_PICKING,
+                    PRIORITY_2D, PRIORITY_3D]  # from the highest priority
+
+# Priority class of the protocols according to its label
+labelPriorities = {'Movies': PRIORITY_PREPROCESSING,
+                   'CTF': PRIORITY_PREPROCESSING,
+                   'Micrographs': PRIORITY_PREPROCESSING,
+                   'Picking': PRIORITY_PICKING,
+                   'Particles': PRIORITY_PICKING,
+                   '2Dclassify': PRIORITY_2D,
+                   'initVol': PRIORITY_3D,
+                   '3Danalysis': PRIORITY_3D,
+                   }
@@ -0,0 +1,231 @@
+# **************************************************************************
+# *
+# * Authors:     em-facilities contributors (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Preflight check of the storage of a session: the deposition folder and the
+projects folder must have room for the whole session and sustain the rate
+of movies expected, estimated from the form and config values.
+"""
+
+import os
+import time
+import ctypes
+import ctypes.util
+
+import pyworkflow.utils as pwutils
+
+from constants import *
+
+MB = 1024 * 1024
+CHUNK_MB = 4
+POSIX_FADV_DONTNEED = 4
+
+# Rough size of the outputs of the workflow, see estimateSession()
+MIC_COPIES = 3  # aligned, dose weighted and preprocessed micrographs
+PARTICLES_PER_MIC = 200
+PARTICLE_COPIES = 2  # extracted and screened particles
+FILES_PER_MIC = 25  # micrographs, PSDs, coordinates, stacks, logs...
+
+# Simulator transfers writing the movies in the deposition folder, the
+#  others only link them (see SIM_TRANSFER)
+SIM_COPIES = ['reflink', 'copy', 'write']
+
+SPEED_MARGIN = 2  # a short benchmark is always optimistic
+MAX_LATENCY_MS = 50  # the project databases need small synced writes
+
+
+def getExistingDir(path):
+    """ The path or its nearest existing parent (i.e. the deposition folder
+        of a simulation is created when it starts).
+    """
+    path = os.path.abspath(path)
+    while not os.path.isdir(path) and path != os.path.dirname(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def _dropCache(fd):
+    """ Drop the pages of fd from the page cache to read them from disk. """
+    if hasattr(os, 'posix_fadvise'):
+        os.posix_fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+    else:  # python 2
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.posix_fadvise(fd, ctypes.c_int64(0), ctypes.c_int64(0),
+                           POSIX_FADV_DONTNEED)
+
+
+def measureStorage(path, sizeMB=256, samples=20):
+    """ Sequential write and read throughput (MB/s, a file of sizeMB written
+        and synced, then read from disk), the median latency of a small
+        synced write (ms), the free space (MB) and free inodes in path.
+    """
+    testFn = os.path.join(path, '.preflight_%d' % os.getpid())
+    chunk = os.urandom(CHUNK_MB * MB)
+    nChunks = max(1, int(sizeMB / CHUNK_MB))
+    try:
+        t0 = time.time()
+        with open(testFn, 'wb') as f:
+            for _ in range(nChunks):
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        writeTime = time.time() - t0
+
+        with open(testFn, 'rb') as f:
+            _dropCache(f.fileno())
+            t0 = time.time()
+            while f.read(CHUNK_MB * MB):
+                pass
+        readTime = time.time() - t0
+
+        latencies = []
+        for _ in range(samples):
+            t0 = time.time()
+            with open(testFn, 'wb') as f:
+                f.write(chunk[:4096])
+                f.flush()
+                os.fsync(f.fileno())
+            latencies.append(time.time() - t0)
+    finally:
+        if os.path.exists(testFn):
+            os.remove(testFn)
+
+    st = os.statvfs(path)
+    return {'writeMBs': nChunks * CHUNK_MB / max(writeTime, 1e-6),
+            'readMBs': nChunks * CHUNK_MB / max(readTime, 1e-6),
+            'latencyMs': sorted(latencies)[len(latencies) // 2] * 1000,
+            'freeMB': st.f_bavail * st.f_frsize / MB,
+            'freeInodes': st.f_favail,
+            'device': os.stat(path).st_dev}
+
+
+def estimateSession(confDict):
+    """ Movies expected, their size and the space, inodes and rates (MB/s)
+        needed in the deposition and projects folders for the whole session.
+        Simulated sessions take the movies and their size from RAWDATA_SIM,
+        and only need deposition space if the movies are not linked.
+    """
+    get = confDict.get
+    moviesPerHour = get(MOVIES_PER_HOUR)
+    # all the frames are stored, whatever the range aligned (FRAMES)
+    movieMB = get(FRAMES_PER_MOVIE) * get(FRAME_MB)
+    movies = int(moviesPerHour * get(TIMEOUT) / 3600.)
+    if get(SIMULATION):
+        rawFiles = pwutils.glob(os.path.join(get(RAWDATA_SIM), get(PATTERN)))
+        if rawFiles:
+            movies = len(rawFiles)
+            movieMB = sum(os.path.getsize(fn)
+                          for fn in rawFiles[:10]) / float(min(10, movies)) / MB
+    depositionMovieMB = movieMB
+    if get(SIMULATION) and get(SIM_TRANSFER, 'link') not in SIM_COPIES:
+        depositionMovieMB = 0  # links, only an inode per movie
+
+    # micrographs are float32 (4 times an 8 bits frame)
+    micMB = MIC_COPIES * 4 * get(FRAME_MB)
+    sampling2D = get(SAMPLING_2D, -1)  # -1 keeps the original sampling
+    box2D = get(PARTSIZE, 0) / (sampling2D if sampling2D > 0
+                                else get(SAMPLING))
+    particlesMB = (PARTICLES_PER_MIC * PARTICLE_COPIES * box2D ** 2 * 4 / MB)
+    parts3D = get(PARTS3D, -1)
+    if get(DO_FULLSIZE, False):
+        fullParts = (PARTICLES_PER_MIC * movies if parts3D < 0
+                     else min(parts3D, PARTICLES_PER_MIC * movies))
+        boxFull = get(PARTSIZE, 0) / get(SAMPLING)
+        fullMB = fullParts * PARTICLE_COPIES * boxFull ** 2 * 4 / MB
+    else:
+        fullMB = 0
+
+    return {'movies': movies,
+            'movieMB': movieMB,
+            'depositionMB': movies * depositionMovieMB,
+            'depositionInodes': movies,
+            'depositionRate': moviesPerHour * depositionMovieMB / 3600.,
+            'projectMB': movies * (micMB + particlesMB) + fullMB,
+            'projectInodes': movies * FILES_PER_MIC,
+            'projectRate': moviesPerHour * (micMB + particlesMB) / 3600.}
+
+
+def checkStorage(confDict, sizeMB=256):
+    """ Measure the deposition and projects folders and compare them with
+        the session estimate. Return the errors (the session would not fit
+        or could not keep up) and the warnings (too close to the limits).
+    """
+    errors, warnings = [], []
+    est = estimateSession(confDict)
+    print("\nPreflight estimate: %d movies of %d MB, %.1f MB/s of movies, "
+          "%.1f MB/s of processing outputs"
+          % (est['movies'], est['movieMB'], est['depositionRate'],
+             est['projectRate']))
+
+    folders = [('Deposition', confDict.get(DEPOSITION_DIR), est['depositionMB'],
+                est['depositionInodes'], est['depositionRate']),
+               ('Projects', confDict.get(PROJECTS_PATH), est['projectMB'],
+                est['projectInodes'], est['projectRate'])]
+    measures = {}
+    for name, path, neededMB, neededInodes, rate in folders:
+        path = getExistingDir(path)
+        try:
+            m = measureStorage(path, sizeMB)
+        except (IOError, OSError) as exc:
+            errors.append("%s folder %s is not writable: %s" % (name, path, exc))
+            continue
+        measures[name] = m
+        print("  %s (%s): write %.0f MB/s, read %.0f MB/s, latency %.1f ms, "
+              "%.0f GB and %d inodes free"
+              % (name, path, m['writeMBs'], m['readMBs'], m['latencyMs'],
+                 m['freeMB'] / 1024, m['freeInodes']))
+
+        if m['freeMB'] < neededMB:
+            errors.append("%s folder %s: %.0f GB free, %.0f GB needed."
+                          % (name, path, m['freeMB'] / 1024, neededMB / 1024))
+        if m['freeInodes'] < neededInodes:
+            errors.append("%s folder %s: %d inodes free, %d needed."
+                          % (name, path, m['freeInodes'], neededInodes))
+        speed = min(m['writeMBs'], m['readMBs'])
+        if speed < rate:
+            errors.append("%s folder %s: %.0f MB/s, it cannot sustain "
+                          "%.1f MB/s." % (name, path, speed, rate))
+        elif speed < rate * SPEED_MARGIN:
+            warnings.append("%s folder %s: %.0f MB/s, too close to the "
+                            "%.1f MB/s needed." % (name, path, speed, rate))
+
+    if 'Projects' in measures:
+        if measures['Projects']['latencyMs'] > MAX_LATENCY_MS:
+            warnings.append("Projects folder: %.0f ms per synced write, the "
+                            "project databases will be slow."
+                            % measures['Projects']['latencyMs'])
+        if ('Deposition' in measures and measures['Deposition']['device'] ==
+                measures['Projects']['device']):
+            # movies written, read and processed on the same filesystem
+            rate = 2 * est['depositionRate'] + est['projectRate']
+            speed = min(measures['Projects']['writeMBs'],
+                        measures['Projects']['readMBs'])
+            if speed < rate * SPEED_MARGIN:
+                warnings.append("Deposition and projects folders share the "
+                                "same filesystem: %.0f MB/s for %.1f MB/s of "
+                                "movies in and out and processing outputs."
+                                % (speed, rate))
+    return errors, warnings
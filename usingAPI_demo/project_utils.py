@@ -0,0 +1,188 @@
+# **************************************************************************
+# *
+# * Authors:     em-facilities contributors (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import time
+import sqlite3
+from collections import OrderedDict
+
+import pyworkflow.protocol as pwprot
+
+LABELS_FILE = 'labels.sqlite'
+LABELS_VERSION = 1
+
+
+class ProjectBatch(object):
+    """ Group all the project database writes done within it in a single
+        transaction. The commits of the project mapper are deferred until
+        the end of the batch and, if deferLaunch, so are the launches of
+        the scheduled protocols (their scheduler processes must find them
+        already committed).
+
+        Usage:
+            with ProjectBatch(project, 'Scheduling'):
+                for prot in runs:
+                    project.scheduleProtocol(prot)
+    """
+    def __init__(self, project, title='Batch', deferLaunch=False):
+        self.project = project
+        self.title = title
+        self.deferLaunch = deferLaunch
+        self.commits = 0
+        self.launches = []
+        self._commit = None
+        self._schedule = None
+        self.startTime = None
+
+    def __enter__(self):
+        self.begin()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.end(commit=excType is None)
+
+    def begin(self):
+        self.startTime = time.time()
+        mapper = self.project.mapper
+        self._commit = mapper.commit
+
+        def _deferredCommit():
+            self.commits += 1
+        mapper.commit = _deferredCommit
+
+        if self.deferLaunch:
+            self._schedule = pwprot.schedule
+
+            def _deferredSchedule(protocol, *args, **kwargs):
+                self.launches.append((protocol, args, kwargs))
+            pwprot.schedule = _deferredSchedule
+
+    def end(self, commit=True):
+        """ Commit (or discard) the batch and launch the deferred protocols.
+        """
+        if not commit:
+            # before the next real commit can store part of the batch
+            self.project.mapper.db.connection.rollback()
+
+        self.project.mapper.commit = self._commit
+        if self.deferLaunch:
+            pwprot.schedule = self._schedule
+
+        if not commit:
+            print("%s aborted: %d deferred commits discarded."
+                  % (self.title, self.commits))
+            return
+
+        buildTime = time.time() - self.startTime
+        t0 = time.time()
+        self._commit()
+        commitTime = time.time() - t0
+
+        t0 = time.time()
+        for protocol, args, kwargs in self.launches:
+            pwprot.schedule(protocol, *args, **kwargs)
+        launchTime = time.time() - t0
+
+        print("%s: %.2f s building, %.2f s in 1 commit (instead of %d)%s"
+              % (self.title, buildTime, commitTime, self.commits,
+                 ", %.2f s launching %d protocols"
+                 % (launchTime, len(self.launches))
+                 if self.deferLaunch else ''))
+
+
+class LabelStore(object):
+    """ Labels and colors of the protocols of a project, kept in a small
+        sqlite file next to the project database. Labels are appended in a
+        transaction once their protocols are stored in the project, and
+        readers only get the entries after the last one they applied.
+
+        Usage:
+            store = LabelStore(project.getPath())
+            store.add([(prot.getObjId(), 'CTF', '#4fc3f7')])
+            lastId, labelsDict, colorsDict = store.getPending()
+            ... apply them ...
+            store.setApplied(lastId)
+    """
+    def __init__(self, projPath):
+        self.fn = os.path.join(projPath, LABELS_FILE)
+        self.db = sqlite3.connect(self.fn)
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version > LABELS_VERSION:
+            raise Exception("%s has version %d, but only up to %d is supported."
+                            % (self.fn, version, LABELS_VERSION))
+        if version < LABELS_VERSION:
+            with self.db:
+                self.db.execute("CREATE TABLE IF NOT EXISTS labels "
+                                "(name TEXT PRIMARY KEY, color TEXT)")
+                self.db.execute("CREATE TABLE IF NOT EXISTS entries "
+                                "(id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                                "protId INTEGER, label TEXT)")
+                self.db.execute("CREATE TABLE IF NOT EXISTS applied "
+                                "(reader TEXT PRIMARY KEY, lastId INTEGER)")
+                self.db.execute("PRAGMA user_version = %d" % LABELS_VERSION)
+
+    def getColors(self):
+        return OrderedDict((str(name), str(color)) for name, color in
+                           self.db.execute("SELECT name, color FROM labels "
+                                           "ORDER BY rowid"))
+
+    def add(self, entries):
+        """ Label the protocols in entries [(protId, labelName, color)],
+            the color is only used for new labels.
+        """
+        with self.db:
+            for protId, labelName, color in entries:
+                self.db.execute("INSERT OR IGNORE INTO labels VALUES (?, ?)",
+                                (labelName, color))
+                self.db.execute("INSERT INTO entries (protId, label) "
+                                "VALUES (?, ?)", (protId, labelName))
+
+    def getPending(self, reader='settings'):
+        """ Return the last entry id, the labelsDict {labelName: [protIds]}
+            of the entries not applied yet by reader and the colorsDict
+            {labelName: color} of those labels.
+        """
+        row = self.db.execute("SELECT lastId FROM applied WHERE reader=?",
+                              (reader,)).fetchone()
+        lastId = row[0] if row else 0
+        labelsDict = OrderedDict()
+        for entryId, protId, labelName in self.db.execute(
+                "SELECT id, protId, label FROM entries WHERE id > ? "
+                "ORDER BY id", (lastId,)):
+            labelsDict.setdefault(str(labelName), []).append(protId)
+            lastId = entryId
+        colors = self.getColors()
+        colorsDict = OrderedDict((labelName, colors[labelName])
+                                 for labelName in labelsDict)
+        return lastId, labelsDict, colorsDict
+
+    def setApplied(self, lastId, reader='settings'):
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO applied VALUES (?, ?)",
+                            (reader, lastId))
+
+    def close(self):
+        self.db.close()
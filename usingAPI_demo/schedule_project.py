@@ -26,63 +26,526 @@
 # **************************************************************************
 
 import sys, os
+import re
+import json
+import time
+import argparse
+import multiprocessing
+from collections import OrderedDict
+from datetime import timedelta
+from fnmatch import fnmatchcase
+
 from pyworkflow.project import Project, Manager
+from pyworkflow.object import Set
 import pyworkflow.utils as pwutils
 
+from constants import (PRIORITY_ATTR, PRIORITY_CLASSES,
+                       PRIORITY_PREPROCESSING)
+from project_utils import ProjectBatch
+
+
+# Rough time (seconds) a protocol needs to deliver its first outputs in
+# streaming, used to estimate the timeline of a plan (see --costs).
+PROTOCOL_COSTS = {'ProtImportMovies': 30,
+                  'XmippProtMovieGain': 120,
+                  'ProtMotionCorr': 60,
+                  'XmippProtMovieCorr': 300,
+                  'XmippProtMovieMaxShift': 30,
+                  'XmippProtOFAlignment': 600,
+                  'ProtGctf': 30,
+                  'XmippProtCTFMicrographs': 120,
+                  'ProtCTFFind': 60,
+                  'XmippProtCTFConsensus': 30,
+                  'XmippProtPreprocessMicrographs': 30,
+                  'XmippProtParticlePicking': 600,
+                  'XmippParticlePickingAutomatic': 300,
+                  'SphireProtCRYOLOPicking': 120,
+                  'ProtRelionAutopickLoG': 60,
+                  'XmippProtConsensusPicking': 30,
+                  'XmippProtExtractParticles': 60,
+                  'XmippProtEliminateEmptyParticles': 30,
+                  'XmippProtTriggerData': 600,
+                  'XmippProtScreenParticles': 30,
+                  'ProtCryo2D': 1800,
+                  'XmippProtCL2D': 1800,
+                  'ProtRelionClassify2D': 1800,
+                  'XmippProtEliminateEmptyClasses': 30,
+                  'ProtUnionSet': 10,
+                  'XmippProtReconstructSignificant': 1800,
+                  'EmanProtInitModel': 1800,
+                  'XmippProtRansac': 1800,
+                  'XmippProtAlignVolume': 300,
+                  'XmippProtReconstructSwarm': 3600,
+                  'XmippProtCropResizeVolumes': 30,
+                  'ProtExtractCoords': 30,
+                  'ProtSubSet': 30,
+                  'ProtRelionRefine3D': 7200,
+                  'ProtRelionClassify3D': 7200,
+                  'ProtCryoSparcInitialModel': 3600,
+                  'XmippProtStrGpuCrrSimple': 300,
+                  'ProtMonitor2dStreamer': 60,
+                  'ProtMonitorSummary': 10}
+DEFAULT_COST = 60
+
 
 def usage(error):
-    print """
+    print("""
     ERROR: %s
 
     Usage: scipion python scripts/schedule_project.py projectName 
     
               options: --ignore ProtClassName1 ProtClassName2 ProtClassLabel1 ...
+                       --include PATTERN1 PATTERN2 ...
+                       --exclude PATTERN1 PATTERN2 ...
+                       --admission [--cpus N] [--gpus 0,1,...] [--gpu-slots N]
+                                   [--poll SECONDS] [--throttle BACKLOG]
+                       --dry-run [--costs costs.json]
 
-        This script will schedule all the protocols in a linear project, 
+        This script will schedule all the protocols in a project following
+          its dependencies graph (the protocols without pending inputs first),
           except for those protocols that belongs to ProtClassName1 or ProtClassName2 class,
           even except fot those protocols with a label equal to ProtClassLabel1
-    """ % error
+
+        The --include and --exclude patterns are matched against the class
+          name and the label of every protocol, as glob patterns ('Relion*')
+          or as regular expressions when prefixed by 're:' ('re:.*2D$').
+          If some --include is given, only the matching protocols are scheduled.
+
+        With --throttle, the admission pauses the lower priority classes
+          while the preprocessing backlog (movies imported but not
+          preprocessed yet) is above BACKLOG: first 3D, then 2D (2*BACKLOG)
+          and then picking (3*BACKLOG). See also supervise_project.py.
+
+        With --dry-run, the execution plan is printed without scheduling
+          anything: the launch waves, the resources claimed by every wave
+          and its estimated time, from a per-class cost table in seconds
+          (see PROTOCOL_COSTS, that can be updated with a json file).
+
+        With --admission, the script keeps running and a protocol is only
+          scheduled when its inputs have been scheduled and the CPUs and GPUs
+          it declares (numberOfMpi x numberOfThreads, gpuList) are free.
+          By default, all the CPUs of the node are used and every GPU declared
+          in the project can run 2 protocols at once (--gpu-slots).
+    """ % error)
     sys.exit(1)
 
 
-n = len(sys.argv)
+def loadProject(projName):
+    path = os.path.join(os.environ['SCIPION_HOME'], 'pyworkflow', 'gui', 'no-tkinter')
+    sys.path.insert(1, path)
+
+    manager = Manager()
+
+    if not manager.hasProject(projName):
+        usage("There is no project with this name: %s"
+              % pwutils.red(projName))
+
+    # the project may be a soft link which may be unavailable to the cluster so get the real path
+    try:
+        projectPath = os.readlink(manager.getProjectPath(projName))
+    except:
+        projectPath = manager.getProjectPath(projName)
+
+    project = Project(projectPath)
+    project.load()
+    return project
+
+
+def getParentIds(prot, protIds):
+    """ Ids of the protocols (within protIds) that prot depends on,
+        either through its input pointers or through its prerequisites.
+    """
+    parents = set()
+    for _, attr in prot.iterInputAttributes():
+        pointed = attr.getObjValue()
+        if pointed is None:
+            continue
+        pointedId = pointed.getObjId()
+        if pointedId not in protIds:
+            # pointing to an output instead of to the protocol
+            pointedId = getattr(pointed, 'getObjParentId', lambda: None)()
+        parents.add(pointedId)
+
+    for protId in prot.getPrerequisites():
+        parents.add(int(protId))
+
+    parents.discard(prot.getObjId())
+    return parents & protIds
+
+
+def getDependencies(runs):
+    """ Return an OrderedDict {protId: set(parentIds)} in creation order. """
+    protIds = set(prot.getObjId() for prot in runs)
+    return OrderedDict((prot.getObjId(), getParentIds(prot, protIds))
+                       for prot in runs)
+
+
+def getLaunchWaves(runs):
+    """ Split the runs in waves following a topological order: every wave
+        only depends on previous waves, so its protocols are independent
+        branches that can be launched at once.
+    """
+    runsDict = OrderedDict((prot.getObjId(), prot) for prot in runs)
+    dependencies = getDependencies(runs)
+    waves = []
+    done = set()
+    pending = list(runsDict)
+    while pending:
+        wave = [protId for protId in pending if dependencies[protId] <= done]
+        if not wave:
+            print(pwutils.yellowStr("Cyclic dependencies found among %s, "
+                                    "scheduling them in creation order."
+                                    % pending))
+            wave = pending
+        waves.append([runsDict[protId] for protId in wave])
+        done.update(wave)
+        pending = [protId for protId in pending if protId not in done]
+    return waves
+
+
+def parseGpus(value):
+    """ Get the GPU ids from strings like '0', '2, 3', '0:1' or '2-3'. """
+    return [int(gpu) for gpu in re.findall(r'\d+', str(value or ''))]
+
+
+def getDemand(prot):
+    """ Return the (cpus, gpus) declared by a protocol through its usual
+        parameters: numberOfMpi, numberOfThreads and gpuList (or gpusToUse).
+    """
+    def _value(name, default=None):
+        attr = getattr(prot, name, None)
+        value = attr.get() if hasattr(attr, 'get') else attr
+        return default if value is None else value
+
+    cpus = max(1, _value('numberOfMpi', 1)) * max(1, _value('numberOfThreads', 1))
+    gpus = []
+    if _value('useGpu', True) and _value('doGpu', True):
+        gpus = parseGpus(_value('gpuList') or _value('gpusToUse'))
+    return cpus, gpus
+
+
+def getOutputSizes(prot):
+    """ {outputName: size} of the output sets of prot, as stored in the
+        project database (no set is opened).
+    """
+    return dict((name, output.getSize())
+                for name, output in prot.iterOutputAttributes(Set))
+
+
+def getPriorityClass(prot):
+    """ The priority class set by preprocessWorkflow, None if unknown. """
+    priority = getattr(prot, PRIORITY_ATTR, None)
+    return priority.get() if priority is not None else None
+
+
+def getPreprocessingBacklog(runs):
+    """ Items imported but not through the preprocessing yet: the items in
+        the first preprocessing protocol with outputs minus the ones in the
+        last one and the ones discarded on the way. A protocol discards every
+        item once (its largest discarded set, i.e. the max shift discards the
+        movies and their micrographs), and of the parallel branches from the
+        same parents (i.e. the CTF estimators) only the largest is counted.
+    """
+    def _kept(sizes):
+        return max([size for name, size in sizes.items()
+                    if 'Discarded' not in name] or [0])
+
+    def _discarded(sizes):
+        return max([size for name, size in sizes.items()
+                    if 'Discarded' in name] or [0])
+
+    dependencies = getDependencies(runs)
+    outputs = [(prot.getObjId(), getOutputSizes(prot))
+               for prot in sorted(runs, key=lambda p: p.getObjId())
+               if getPriorityClass(prot) == PRIORITY_PREPROCESSING]
+    outputs = [(protId, sizes) for protId, sizes in outputs if sizes]
+    if len(outputs) < 2:
+        return 0
+    discarded = {}  # {parentIds: the most discarded by a branch from them}
+    for protId, sizes in outputs[1:]:
+        parentIds = frozenset(dependencies[protId])
+        discarded[parentIds] = max(discarded.get(parentIds, 0),
+                                   _discarded(sizes))
+    return max(0, _kept(outputs[0][1]) - _kept(outputs[-1][1]) -
+               sum(discarded.values()))
+
+
+class PriorityThrottle(object):
+    """ Pause the lower priority classes while the preprocessing backlog is
+        above threshold: 3D beyond 1 threshold, also 2D beyond 2 and also
+        picking beyond 3. A level is left when the backlog falls half a
+        threshold below it, to avoid pausing and resuming at every poll.
+    """
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.level = 0  # number of classes paused, from the lowest one
+
+    def update(self, runs):
+        backlog = getPreprocessingBacklog(runs)
+        level = min(len(PRIORITY_CLASSES) - 1, int(backlog / self.threshold))
+        if self.level > level and backlog > (self.level - .5) * self.threshold:
+            level = self.level
+        if level != self.level:
+            self.level = level
+            print(pwutils.yellowStr("Preprocessing backlog of %d items: "
+                                    "%s paused." % (backlog, ', '.join(
+                                        self.getPaused()) or 'nothing')))
+        return backlog
+
+    def getPaused(self):
+        return PRIORITY_CLASSES[len(PRIORITY_CLASSES) - self.level:]
+
+    def isPaused(self, prot):
+        return self.level > 0 and getPriorityClass(prot) in self.getPaused()
+
+
+class AdmissionScheduler(object):
+    """ Schedule the runs only when the resources they declare are free.
+        Pending runs are admitted by priority (launch wave and creation
+        order), and their resources are released when they stop being
+        active. A demand larger than the node is clamped to the node size,
+        and GPUs not in the node are not accounted.
+        With a throttle, the runs of the paused priority classes wait.
+    """
+    def __init__(self, project, waves, cpus, gpus, gpuSlots=2, poll=30,
+                 throttle=None):
+        self.project = project
+        self.poll = poll
+        self.throttle = throttle
+        self.freeCpus = self.totalCpus = cpus
+        self.freeGpus = dict((gpu, gpuSlots) for gpu in gpus)
+        self.pending = [prot for wave in waves for prot in wave]
+        self.dependencies = getDependencies(self.pending)
+        self.admitted = OrderedDict()  # protId: (cpus, gpus)
+        self.released = set()
+        self.unknownGpus = set()  # protIds already warned
+
+    def _fits(self, cpus, gpus):
+        return (min(cpus, self.totalCpus) <= self.freeCpus and
+                all(self.freeGpus.get(gpu, 0) > 0 for gpu in gpus))
+
+    def _getKnownGpus(self, prot, gpus):
+        unknown = [gpu for gpu in gpus if gpu not in self.freeGpus]
+        if unknown and prot.getObjId() not in self.unknownGpus:
+            self.unknownGpus.add(prot.getObjId())
+            print(pwutils.yellowStr("%s uses GPUs %s, not in --gpus %s: they "
+                                    "are not accounted."
+                                    % (prot.getObjLabel(), unknown,
+                                       sorted(self.freeGpus))))
+        return [gpu for gpu in gpus if gpu in self.freeGpus]
+
+    def _acquire(self, prot, cpus, gpus):
+        cpus = min(cpus, self.totalCpus)
+        self.freeCpus -= cpus
+        for gpu in gpus:
+            self.freeGpus[gpu] -= 1
+        self.admitted[prot.getObjId()] = (cpus, gpus)
+
+    def _release(self, protId):
+        cpus, gpus = self.admitted[protId]
+        self.freeCpus += cpus
+        for gpu in gpus:
+            self.freeGpus[gpu] += 1
+        self.released.add(protId)
+
+    def _releaseInactive(self, runs):
+        runs = dict((prot.getObjId(), prot) for prot in runs)
+        for protId in self.admitted:
+            if protId in self.released:
+                continue
+            prot = runs.get(protId)
+            if prot is None or not prot.isActive():
+                self._release(protId)
+                print("Released %s resources: %d CPUs free, GPUs %s"
+                      % (prot.getObjLabel() if prot else protId,
+                         self.freeCpus, self.freeGpus))
+
+    def _admitPending(self):
+        protIds = set(self.dependencies)
+        admitted = []
+        for prot in list(self.pending):
+            parents = self.dependencies[prot.getObjId()] & protIds
+            if any(p not in self.admitted for p in parents):
+                continue
+            if self.throttle is not None and self.throttle.isPaused(prot):
+                continue
+            cpus, gpus = getDemand(prot)
+            gpus = self._getKnownGpus(prot, gpus)
+            if self._fits(cpus, gpus):
+                self._acquire(prot, cpus, gpus)
+                self.pending.remove(prot)
+                print("Scheduling %s (%d CPUs, GPUs %s)"
+                      % (prot.getObjLabel(), cpus, gpus))
+                admitted.append(prot)
+        if admitted:
+            scheduleProtocols(self.project, admitted)
+
+    def run(self):
+        nWaiting = 0
+        while True:
+            runs = self.project.getRuns(refresh=True)
+            self._releaseInactive(runs)
+            if self.throttle is not None:
+                self.throttle.update(runs)
+            self._admitPending()
+            if not self.pending:
+                break
+            if len(self.pending) != nWaiting:
+                nWaiting = len(self.pending)
+                print("%d protocols waiting for resources..." % nWaiting)
+            time.sleep(self.poll)
+
+
+def scheduleProtocols(project, prots):
+    """ Schedule all prots in a single database transaction. """
+    with ProjectBatch(project, 'Scheduling %d protocols' % len(prots),
+                      deferLaunch=True):
+        for prot in prots:
+            project.scheduleProtocol(prot)
+
+
+def isIgnored(prot, ignoreList):
+    return (prot.getClassName() in ignoreList or
+            prot.getObjLabel() in ignoreList)
+
+
+def matchesAny(prot, patterns):
+    """ Whether the class name or label of prot matches any of the glob
+        patterns (or regular expressions, if prefixed by 're:').
+    """
+    names = (prot.getClassName(), prot.getObjLabel())
+    for pattern in patterns:
+        if pattern.startswith('re:'):
+            if any(re.search(pattern[3:], name) for name in names):
+                return True
+        elif any(fnmatchcase(name, pattern) for name in names):
+            return True
+    return False
+
+
+def isSelected(prot, args):
+    if args.include and not matchesAny(prot, args.include):
+        return False
+    return not (isIgnored(prot, args.ignore) or
+                matchesAny(prot, args.exclude))
+
+
+def getCapacity(args, runs):
+    """ CPUs and GPUs of the node, the GPUs declared in runs by default. """
+    cpus = args.cpus or multiprocessing.cpu_count()
+    if args.gpus is not None:
+        gpus = parseGpus(args.gpus)
+    else:
+        gpus = sorted(set(gpu for prot in runs for gpu in getDemand(prot)[1]))
+    return cpus, gpus
+
+
+def printPlan(waves, cpus, gpus, gpuSlots, costs):
+    """ Print the launch waves with the resources they claim and their
+        estimated time. Protocols of a wave run in parallel, but the time of
+        an oversubscribed wave is stretched by its demand/capacity ratio.
+    """
+    print("\nExecution plan (%d CPUs, GPUs %s with %d slots each):"
+          % (cpus, gpus, gpuSlots))
+    start = 0
+    for i, wave in enumerate(waves):
+        waveCpus = 0
+        gpuUse = {}
+        cost = 0
+        for prot in wave:
+            protCpus, protGpus = getDemand(prot)
+            waveCpus += protCpus
+            for gpu in protGpus:
+                gpuUse[gpu] = gpuUse.get(gpu, 0) + 1
+            cost = max(cost, costs.get(prot.getClassName(), DEFAULT_COST))
+        load = max([1., float(waveCpus) / cpus] +
+                   [float(n) / gpuSlots for n in gpuUse.values()])
+        waveTime = int(cost * load)
+        warning = ''
+        if load > 1:
+            warning = pwutils.redStr("  !! oversubscribed x%.1f" % load)
+        elif any(gpu not in gpus for gpu in gpuUse):
+            warning = pwutils.redStr("  !! unknown GPUs")
+
+        print("\nWave %d [%s - %s]: %d CPUs, GPUs %s%s"
+              % (i + 1, timedelta(seconds=start),
+                 timedelta(seconds=start + waveTime), waveCpus,
+                 ', '.join('%d(x%d)' % kv for kv in sorted(gpuUse.items()))
+                 or '-', warning))
+        for prot in wave:
+            protCpus, protGpus = getDemand(prot)
+            print("   - %s (%s): %d CPUs, GPUs %s, ~%d s"
+                  % (prot.getObjLabel(), prot.getClassName(), protCpus,
+                     protGpus or '-',
+                     costs.get(prot.getClassName(), DEFAULT_COST)))
+        start += waveTime
+    print("\nEstimated time to launch all the protocols: %s\n"
+          % timedelta(seconds=start))
+
 
-if n < 2:
-    usage("This script accepts 1 mandatory parameter: the project name.")
-elif n > 2 and sys.argv[2] != '--ignore':
-    usage("The protocol class names to be ignored must be after a '--ignore' flag.")
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('projName')
+    parser.add_argument('--ignore', nargs='*', default=[])
+    parser.add_argument('--include', nargs='*', default=[])
+    parser.add_argument('--exclude', nargs='*', default=[])
+    parser.add_argument('--dry-run', dest='dryRun', action='store_true')
+    parser.add_argument('--costs', default=None)
+    parser.add_argument('--admission', action='store_true')
+    parser.add_argument('--cpus', type=int, default=0)
+    parser.add_argument('--gpus', default=None)
+    parser.add_argument('--gpu-slots', dest='gpuSlots', type=int, default=2)
+    parser.add_argument('--poll', type=float, default=30)
+    parser.add_argument('--throttle', type=int, default=0)
 
-projName = sys.argv[1]
+    if len(argv) > 1 and not argv[1].startswith('--'):
+        usage("The protocol class names to be ignored must be after a '--ignore' flag.")
+    try:
+        return parser.parse_args(argv)
+    except SystemExit:
+        usage("This script accepts 1 mandatory parameter: the project name.")
 
-path = os.path.join(os.environ['SCIPION_HOME'], 'pyworkflow', 'gui', 'no-tkinter')
-sys.path.insert(1, path)
 
-# Create a new project
-manager = Manager()
+if __name__ == '__main__':
+    args = parseArgs(sys.argv[1:])
 
-if not manager.hasProject(projName):
-    usage("There is no project with this name: %s"
-          % pwutils.red(projName))
+    project = loadProject(args.projName)
 
-# the project may be a soft link which may be unavailable to the cluster so get the real path
-try:
-    projectPath = os.readlink(manager.getProjectPath(projName))
-except:
-    projectPath = manager.getProjectPath(projName)
+    # Waves are computed with all the runs to keep the real dependencies
+    allRuns = project.getRuns()
+    waves = []
+    for wave in getLaunchWaves(allRuns):
+        selected = []
+        for prot in wave:
+            if isSelected(prot, args):
+                selected.append(prot)
+            else:
+                print(pwutils.yellowStr("\nNot scheduling '%s' protocol named '%s'.\n"
+                                        % (prot.getClassName(), prot.getObjLabel())))
+        if selected:
+            waves.append(selected)
+    runs = [prot for wave in waves for prot in wave]
+    cpus, gpus = getCapacity(args, runs)
 
-project = Project(projectPath)
-project.load()
+    if args.dryRun:
+        costs = dict(PROTOCOL_COSTS)
+        if args.costs:
+            with open(args.costs) as f:
+                costs.update(json.load(f))
+        printPlan(waves, cpus, gpus, args.gpuSlots, costs)
+        sys.exit(0)
 
-runs = project.getRuns()
+    # Upstream protocols are scheduled first, and every wave gathers the
+    # independent branches that wait for the same stage (i.e. all pickers)
+    for i, wave in enumerate(waves):
+        print("\nWave %d: %s" % (i + 1, ', '.join(prot.getObjLabel()
+                                                  for prot in wave)))
 
-# Now assuming that there is no dependencies between runs
-# and the graph is lineal
-for prot in runs:
-    protClassName = prot.getClassName()
-    protLabelName = prot.getObjLabel()
-    if (protClassName not in sys.argv[3:] and
-        protLabelName not in sys.argv[3:]):
-        project.scheduleProtocol(prot)
+    if args.admission:
+        print("\nAdmission control with %d CPUs and GPUs %s (%d slots each)"
+              % (cpus, gpus, args.gpuSlots))
+        throttle = PriorityThrottle(args.throttle) if args.throttle else None
+        AdmissionScheduler(project, waves, cpus, gpus, args.gpuSlots,
+                           args.poll, throttle).run()
     else:
-        print(pwutils.yellowStr("\nNot scheduling '%s' protocol named '%s'.\n"
-                                % (protClassName, protLabelName)))
+        scheduleProtocols(project, runs)
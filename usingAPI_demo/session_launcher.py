@@ -0,0 +1,953 @@
+# **************************************************************************
+# *
+# * Authors:     em-facilities contributors (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Create a new session without any window, taking the form fields from the
+config file, the form defaults and the KEY=VALUE overrides given.
+
+Usage: scipion python session_launcher.py [scipionbox.conf]
+                                          [--microscope NAME] [KEY=VALUE ...]
+
+  i.e. scipion python session_launcher.py USER_NAME=jdoe SAMPLE_NAME=apoF \
+                                          PARTSIZE=150 SYMGROUP=o
+
+  With --microscope, the [MICROSCOPE:NAME] section of the config is used
+  on top of the common ones.
+
+  The same checks than in form_launcher.py are done before building the
+  workflow, and Tkinter is never imported.
+
+  As the form, it only creates the project: it is neither labelled nor
+  scheduled (wizard.sh does it after the form). Run then
+      scipion python set_labels_colors.py PROJECT_NAME --headless
+      scipion python schedule_project.py PROJECT_NAME
+"""
+import os
+import sys
+import re
+import time
+import json
+import hashlib
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+import traceback
+from fnmatch import fnmatch
+from collections import OrderedDict
+from ConfigParser import SafeConfigParser
+from StringIO import StringIO
+
+from constants import *
+from preflight import checkStorage
+from simulation_process import SIM_DIR, SimulationProcess, stopRunaways
+
+import pyworkflow as pw
+import pyworkflow.utils as pwutils
+
+# Parsed config files, per user (see readConfFile)
+CONF_CACHE_DIR = os.path.join(os.environ.get('SCIPION_USER_DATA',
+                                             os.path.expanduser(
+                                                 '~/ScipionUserData')),
+                              'tmp')
+PROFILE_PREFIX = 'MICROSCOPE:'  # sections with the config of each microscope
+parsedConfs = {}  # confFile: (mtime, sections), see readConfFile
+
+# inotify events of a file completely written (see inotify.h)
+IN_CLOSE_WRITE = 0x08
+IN_MOVED_TO = 0x80
+
+
+def getFormFields(confDict):
+    """ The fields of the session form according to the ASK_* parameters of
+        the config, as an OrderedDict {key: (default, isCheckbox)}.
+    """
+    def ask(askKey, default):
+        return confDict.get(askKey, default) or confDict.get(ASK_ALL, False)
+
+    fields = OrderedDict()
+    def add(key, default, isCheckbox=False):
+        fields[key] = (default, isCheckbox)
+
+    ### Acquisition Info ###
+    add(PROJECT_NAME, None)  # made from the user and sample names
+    if PROJECT_NAME not in confDict:
+        add(USER_NAME, 'mySelf')
+        add(SAMPLE_NAME, 'myProtein')
+    if os.environ.get(PATTERN, False):
+        add(DEPOSITION_PATTERN, confDict.get(DEPOSITION_PATTERN))
+    if ask(ASK_PATH, True):
+        add(RAWDATA_SIM if confDict.get(SIMULATION, False) else DEPOSITION_DIR, '')
+
+    ### MotionCor2 parameters ###
+    add(FRAMES, '3-0')
+    add(DOSE0, '0')
+    add(DOSEF, '1.18')
+
+    ### Picking parameters ###
+    if ask(ASK_PARTSIZE, True):
+        add(PARTSIZE, '250')
+    if ask(ASK_MICS2PIC, False):
+        add(MICS2PICK, '10')
+    if ask(ASK_PICK_PROT, False):
+        add(CRYOLO, True, True)
+        add(RELION_PICK, True, True)
+
+    ### 2D Classification ###
+    add(DO_2DCLASS, True, True)
+    if ask(ASK_2DSAMP, True):
+        add(SAMPLING_2D, '3')
+    if ask(ASK_PARTS2CLASS, True):
+        add(PARTS2CLASS, '3000')
+    if ask(ASK_2D_PROT, False):
+        add(RELION_2D, True, True)
+        add(XMIPP_2D, True, True)
+        add(CRYOS_2D, True, True)
+
+    ### Initial volume estimation ###
+    add(DO_INITVOL, True, True)
+    if ask(ASK_SYMGROUP, True):
+        add(SYMGROUP, 'd2')
+    if ask(ASK_INITVOL_PROT, False):
+        add(EMAN_INITIAL, True, True)
+        add(SIGNIFICANT, True, True)
+        add(RANSAC, False, True)
+
+    ### 3D Classification
+    add(DO_3DCLASS, True, True)
+    if ask(ASK_3DSAMP, True):
+        add(SAMPLING_3D, '1')
+    if ask(ASK_PARTS3D, True):
+        add(PARTS3D, '10000')
+    if ask(ASK_3D_PROT, True):
+        add(RELION_REFINE, False, True)
+        add(RELION_3DCL, True, True)
+        add(CRYOS_3D, True, True)
+
+    ### Extract particles FULL SIZE
+    if ask(ASK_FULLSIZE, False):
+        add(DO_FULLSIZE, True, True)
+
+    ### RESOURCES
+    if ask(ASK_RESOURCES, False):
+        add(MOTIONCOR2_GPU, '2-3')
+        add(GCTF_GPU, '2')
+        add(RELION_GPU, '1')
+        add(GL2D_GPU, '0')
+
+    return fields
+
+
+class FileWaiter(object):
+    """ Wait for the first complete file matching a glob pattern.
+
+        The files closed after writing (or renamed) in the pattern folder are
+        caught as soon as they arrive through inotify, when available. The
+        pattern is also globbed every poll seconds for the files that inotify
+        can not see (written from other hosts on network filesystems or in
+        subfolders), taking them as complete when their size does not change
+        between two polls.
+    """
+    def __init__(self, pattern, poll=2):
+        self.pattern = pattern
+        self.poll = poll
+        self.sizes = {}
+        # the deepest folder without wildcards
+        self.folder = os.path.dirname(pattern)
+        while re.search('[*?[]', self.folder):
+            self.folder = os.path.dirname(self.folder)
+        self.fd = self._watch()
+
+    def _watch(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init()
+        except (OSError, AttributeError):  # not in Linux
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, self.folder,
+                                  IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def _readEvents(self, timeout):
+        """ Return the files written in the folder, within timeout seconds.
+        """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        files = []
+        i = 0
+        while i < len(data):  # struct inotify_event + name
+            _, _, _, length = struct.unpack_from('iIII', data, i)
+            name = data[i + 16:i + 16 + length].rstrip('\0')
+            files.append(os.path.join(self.folder, name))
+            i += 16 + length
+        return files
+
+    def _pollFiles(self):
+        now = time.time()
+        sizes = {}
+        for fn in pwutils.glob(self.pattern):
+            try:
+                sizes[fn] = os.path.getsize(fn)
+                old = now - os.path.getmtime(fn) > self.poll
+            except OSError:  # removed meanwhile
+                continue
+            if sizes[fn] and (old or self.sizes.get(fn) == sizes[fn]):
+                return fn
+        self.sizes = sizes
+        return None
+
+    def wait(self, timeout, progress=None):
+        """ Return the first file found, or None after timeout seconds.
+            progress(elapsedSeconds, timeout) is called while waiting.
+        """
+        start = time.time()
+        while True:
+            found = self._pollFiles()
+            if found:
+                return found
+            elapsed = time.time() - start
+            if elapsed >= timeout:
+                return None
+            if progress is not None:
+                progress(elapsed, timeout)
+
+            wait = min(self.poll, timeout - elapsed)
+            if self.fd is None:
+                time.sleep(wait)
+                continue
+            for fn in self._readEvents(wait):
+                if fnmatch(fn, self.pattern) and os.path.getsize(fn):
+                    return fn
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class SessionCancelled(Exception):
+    pass
+
+
+class WorkflowBuilder(threading.Thread):
+    """ Build the workflow project in the background, so it is ready when
+        the first movie arrives. The error, if any, is kept to be raised by
+        the caller after join().
+    """
+    def __init__(self, configDict):
+        threading.Thread.__init__(self, name='WorkflowBuilder')
+        self.daemon = True
+        self.configDict = configDict
+        self.project = None
+        self.error = None
+        self.traceback = None
+        self.elapsed = None
+
+    def run(self):
+        from acquisition_workflow import preprocessWorkflow
+
+        t0 = time.time()
+        try:
+            self.project = preprocessWorkflow(self.configDict)
+        except Exception as exc:
+            self.error = exc
+            self.traceback = traceback.format_exc()
+        self.elapsed = time.time() - t0
+
+
+class SessionForm(object):
+    """ The values, checks and project creation of the session form,
+        with nothing about how the fields are shown. Subclasses give the
+        form values (_getValue and _setValue) and how to notify the user.
+    """
+    def __init__(self, configDict):
+        self.vars = {}
+        self.configDict = configDict
+        self.simulation = None
+        self.builder = None  # building the project, see _buildAndWait()
+        self.discarded = None  # the project deleted when the creation failed
+        self.created = False
+        self.warnings = []  # not blocking the session, see validate()
+        self.cancelled = threading.Event()  # set from any thread by cancel()
+        self.stage = None
+        self.lastStage = None  # the one running when the last stage ended
+        self.stageStart = None
+        self.stageTimes = OrderedDict()  # stage: seconds
+        # Regular expression to validate username and sample name
+        self.re = re.compile('\A[a-zA-Z0-9][a-zA-Z0-9_-]+[a-zA-Z0-9]\Z')
+
+    def _getValue(self, varKey):
+        return self.vars.get(varKey)
+
+    def _setValue(self, varKey, value):
+        self.vars[varKey] = value
+
+    def _showProgress(self, elapsed, timeout):
+        """ timeout is None once the data has been found (or given up) and
+            only the build of the project is left.
+        """
+        if timeout is None:
+            sys.stdout.write("\rBuilding the project... %d s" % elapsed)
+        else:
+            sys.stdout.write("\rWaiting for the first movie in %s... %d/%d s"
+                             % (self.getConfValue(DEPOSITION_DIR),
+                                elapsed, timeout))
+        sys.stdout.flush()
+
+    def getProjectPath(self):
+        return os.path.join(self.getConfValue(PROJECTS_PATH),
+                            self.getConfValue(PROJECT_NAME))
+
+    def cancel(self):
+        """ Stop validate() or createProject() at the next safe point. """
+        self.cancelled.set()
+
+    def _checkCancelled(self):
+        if self.cancelled.is_set():
+            raise SessionCancelled("Session cancelled during '%s'."
+                                   % self.stage)
+
+    def _startStage(self, stage):
+        """ End the current stage, keeping its time, and start stage. """
+        now = time.time()
+        if self.stage is not None:
+            self.lastStage = self.stage
+            self.stageTimes[self.stage] = now - self.stageStart
+            print("\n%s: %.1f s" % (self.stage, self.stageTimes[self.stage]))
+        self.stage, self.stageStart = stage, now
+        if stage is not None:
+            self._showStage(stage)
+
+    def _showStage(self, stage):
+        print("\n>>> %s..." % stage)
+
+    def validate(self):
+        """ Cast the form values and return the list of errors found. """
+        try:
+            return self._validate()
+        finally:
+            self._startStage(None)
+
+    def _validate(self):
+        self._startStage("Checking the form")
+        errors = []
+
+        # Check form parameters
+        errors = self.checkNames(errors)
+
+        # Loading all vars in the form and check types
+        errors = self.castParameters(errors)
+        if not errors:
+            # Check project path only if no problems with project name
+            if os.path.exists(self.getProjectPath()):
+                errors.append("Project '%s' already exists.\n"
+                              "Change User or Sample name"
+                              % self.getProjectPath())
+
+        if not errors:
+            # Do more checks only if there are not previous errors
+            errors = self.checkWorkflowParams()
+
+        self.warnings = []
+        if not errors and self.getConfValue(PREFLIGHT, True):
+            # The storage is only measured for a valid session
+            self._checkCancelled()
+            self._startStage("Checking the storage")
+            errors, self.warnings = checkStorage(
+                self.configDict, self.getConfValue(PREFLIGHT_MB, 256))
+
+        return errors
+
+    def createProject(self):
+        try:
+            self._createProject()
+        finally:
+            self._startStage(None)
+
+    def _createProject(self):
+        self._checkCancelled()
+        self.discarded = None
+        dataPath = self.getConfValue(DEPOSITION_PATTERN)
+        projectName = self.getConfValue(PROJECT_NAME)
+        projectPath = os.path.join(self.getConfValue(PROJECTS_PATH), projectName)
+
+        print("")
+        print("Deposition Pattern: %s" % dataPath)
+        print("Project Name: %s" % projectName)
+        print("Project Path: %s" % projectPath)
+
+        # Launch the simulation
+        if self.getConfValue(SIMULATION):
+            rawData = self.getConfValue(RAWDATA_SIM)
+
+            gainGlob = pwutils.glob(os.path.join(rawData,
+                                                 self.getConfValue(GAIN_PAT)))
+            rawDataPath = os.path.join(rawData, self.getConfValue(PATTERN))
+
+            # runaway simulations of finished sessions only take I/O
+            self._startStage("Starting the simulation")
+            depositionDir = self.getConfValue(DEPOSITION_DIR)
+            stopRunaways(depositionDir)
+            self.simulation = SimulationProcess.start(
+                [pw.getScipionScript(), 'python', 'simulate_acquisition.py',
+                 rawDataPath, depositionDir,
+                 str(int(self.getConfValue(TIMEOUT)))] + gainGlob[:1] +
+                ['--transfer', self.getConfValue(SIM_TRANSFER, 'link')],
+                os.path.join(SIM_DIR, '%s.log' % projectName), depositionDir)
+            print("Simulation started (pid %d), log in %s"
+                  % (self.simulation.pid, self.simulation.info['log']))
+
+        try:
+            self._buildAndWait(dataPath, projectName)
+        except:
+            if self.simulation is not None:
+                self.simulation.stop()
+            self._discardProject(projectName)
+            raise
+        self.created = True
+
+        if self.simulation is not None:
+            print("The simulation keeps running until the session ends: "
+                  "scipion python simulation_process.py stop %d"
+                  % self.simulation.pid)
+
+    def _buildAndWait(self, dataPath, projectName):
+        from acquisition_workflow import updateGain
+
+        # The project does not need any movie, only its gain does
+        builder = self.builder = WorkflowBuilder(self.configDict)
+        builder.start()
+
+        def progress(elapsed, timeout):
+            self._showProgress(elapsed, timeout)
+            self._checkCancelled()
+
+        # Wait for the first movie to be completely written
+        self._startStage("Waiting for the first movie")
+        t0 = time.time()
+        waiter = FileWaiter(dataPath)
+        try:
+            firstFile = waiter.wait(self.getConfValue(DATA_TIMEOUT), progress)
+        except SessionCancelled:
+            firstFile = None  # the project is deleted once built
+        finally:
+            waiter.close()
+        waitTime = time.time() - t0
+        if firstFile is not None:
+            print("\nFirst movie found: %s" % firstFile)
+
+        self._startStage("Building the project")
+        while builder.isAlive():
+            builder.join(1)
+            self._showProgress(time.time() - t0, None)
+        if builder.error is not None:
+            print(builder.traceback)
+            raise builder.error
+        print("\nProject built in %.1f s, %.1f s while waiting for data."
+              % (builder.elapsed, min(builder.elapsed, waitTime)))
+        self._checkCancelled()
+
+        if firstFile is None:
+            raise Exception("No file found in %s after %d seconds. Make sure "
+                            "that the acquisition has been started."
+                            % (dataPath, self.getConfValue(DATA_TIMEOUT)))
+        self._startStage("Setting the gain")
+        updateGain(builder.project, self.configDict)
+
+        os.system('touch /tmp/scipion/project_%s' % projectName)
+        if self.getConfValue(WAIT2PICK, False):
+            os.system('touch /tmp/scipion/wait2pick_%s' % projectName)
+
+    def _discardProject(self, projectName):
+        """ Delete the project of a session that failed or was cancelled,
+            so the same session can be created again. The build can not be
+            interrupted, thus it is waited first.
+        """
+        if self.builder is None:
+            return
+        while self.builder.isAlive():
+            self.builder.join(1)
+        self.builder = None
+        projectPath = self.getProjectPath()
+        if not os.path.exists(projectPath):
+            return
+        from pyworkflow.project import Manager
+        Manager().deleteProject(projectName)
+        pwutils.cleanPath(projectPath)  # if not in the Scipion projects
+        self.discarded = projectPath
+        print("\nProject %s deleted, the session can be created again."
+              % projectPath)
+
+    def getConfValue(self, key, default=None):
+        return self.configDict.get(key, default)
+
+    def setConfValue(self, key, value):
+        self.configDict.update({key: value})
+
+    def get(self, varKey, default=None):
+        return getattr(self, varKey, default)
+
+    def _getProjectName(self):
+        usr = self._getUserName()
+        sam = self._getSampleName()
+        return '%s_%s_%s' % (pwutils.prettyTime(dateFormat='%Y%m%d'), usr, sam)
+
+    def _getSampleName(self):
+        try:
+            sam = self._getValue(SAMPLE_NAME)
+            sam = 'myProtein' if sam is None else sam
+        except:
+            sam = 'myProtein'
+        return sam
+
+    def _getUserName(self):
+        try:
+            usr = self._getValue(USER_NAME)
+            usr = 'mySelf' if usr is None else usr
+        except:
+            usr = 'mySelf'
+        return usr
+
+    def checkNames(self, errors):
+        dataFolder = self.getConfValue(DEPOSITION_DIR)
+        if not os.path.exists(dataFolder):
+            errors.append("Data folder '%s' does not exists. "
+                          "Check config file." % dataFolder)
+        userName = self._getUserName()
+        if self.re.match(userName.strip()) is None:
+            errors.append("Wrong username")
+        sampleName = self._getSampleName()
+        if self.re.match(sampleName.strip()) is None:
+            errors.append("Wrong sample name")
+        return errors
+
+    def checkWorkflowParams(self):
+        errors = []
+
+        if not errors:
+            self.checkPickingParameters(errors)
+
+        if not errors:
+            self.check2DParameters(errors)
+
+
+        if errors:
+            outErr = ['Some incompatible parameters found:']
+            return outErr + errors
+        else:
+            return errors
+
+    def checkPickingParameters(self, errors):
+        errors = []
+        if (not self.getConfValue(CRYOLO) and
+            not self.getConfValue(RELION_PICK) and
+            # not self.getConfValue(SPARX) and
+            # not self.getConfValue(DOGPICK) and
+            self.getConfValue(PARTSIZE) != 0):
+            errors.append("At least, one picker is needed. "
+                        "Choose crYOLO or Relion LoG, or "
+                        "fix the particle size to 0 for a manual picking.")
+            return errors
+
+        if (self.getConfValue(PARTSIZE) == 0 and
+            self.getConfValue(MICS2PICK) == 0):
+            errors.append("If no partivle size is provides, "
+                          "a manual picking must be done. "
+                          "Thus, please indicate some mics to manula pick "
+                          "(MICS2PIC in config file)")
+            return errors
+
+        return errors
+
+    def check2DParameters(self, errors):
+        pass
+
+
+    def castParameters(self, errors):
+        print("Getting parameters form the form:")
+        for var in self.vars:
+            try:
+                cast = formatsParameters.get(var, 'default')
+                value = self._getValue(var)
+                if cast == 'default':
+                    newvar = value
+                elif cast == 'splitInt':
+                    if value == '':
+                        aux = ['1', '0']
+                    elif '-' in value:
+                        aux = value.split('-')
+                    else:
+                        aux = ['0', '0']
+                        errors.append("'%s' is not well formated (ie. 2-15)"
+                                      % LABELS.get(var))
+                    newvar = [int(item) for item in aux]
+                else:
+                    if value == '':
+                        value = 0
+                    newvar = cast(value)
+                print(" - %s (%s): %s %s" % (var, value, newvar, type(newvar)))
+                self.setConfValue(var, newvar)
+
+            except Exception as e:
+                if cast == int:
+                    errors.append("'%s' should be an integer" % LABELS.get(var))
+                elif cast == float:
+                    errors.append("'%s' should be a float" % LABELS.get(var))
+                else:
+                    errors.append("'%s': %s" % (LABELS.get(var), str(e)))
+
+        # Setting some special parameters
+        if self.getConfValue(SIMULATION):
+            # We classify the acquisitions in projects when simulation
+            self.setConfValue(DEPOSITION_DIR,
+                              os.path.join(self.getConfValue(DEPOSITION_DIR),
+                                           self.getConfValue(PROJECT_NAME)))
+        if DEPOSITION_PATTERN not in self.configDict:
+            # The pattern can be token from the environ
+            pattern = os.path.join(self.getConfValue(DEPOSITION_DIR),
+                                   os.environ.get(PATTERN,
+                                                  self.getConfValue(PATTERN)))
+            self.setConfValue(DEPOSITION_PATTERN, pattern)
+        if PROJECTS_PATH not in self.configDict:
+            scipionProjPath = os.path.join(os.environ.get('SCIPION_USER_DATA'),
+                                           'projects')
+            self.setConfValue(PROJECTS_PATH, scipionProjPath)
+        print("\n -------------------- \n")
+        return errors
+
+
+class HeadlessSession(SessionForm):
+    """ The session form without window: every field takes the value in
+        the overrides, in the config or the form default, in that order.
+    """
+    def __init__(self, configDict, overrides=None):
+        SessionForm.__init__(self, configDict)
+        overrides = overrides or {}
+
+        # overrides of the config may change the fields in the form
+        newConf = dict(configDict)
+        newConf.update((key, castConf(key, value))
+                       for key, value in overrides.items())
+        fields = getFormFields(newConf)
+
+        for key, value in overrides.items():
+            if key not in fields:
+                if globals().get(key) != key:  # not any of the constants
+                    print(pwutils.yellowStr("Unknown parameter '%s', "
+                                            "setting it anyway." % key))
+                self.setConfValue(key, newConf[key])
+
+        for key, (default, isCheckbox) in fields.items():
+            if key in overrides:
+                value = overrides[key]
+                if isCheckbox:
+                    value = value.lower() in ['1', 'true', 'yes', 'y', 'on']
+            else:  # as the form does with its Tk variables
+                value = self.getConfValue(key, default)
+                if isCheckbox:
+                    value = bool(value)
+                elif value is not None:
+                    value = str(value)
+            self._setValue(key, value)
+
+        if self._getValue(PROJECT_NAME) is None:
+            self._setValue(PROJECT_NAME, self._getProjectName())
+
+
+def getMandatories():
+    return [name for name, (_, _, isMandatory) in confSchema.items()
+            if isMandatory]
+
+
+def _toStr(value):
+    """ json gives unicode strings in python 2 """
+    return value if isinstance(value, str) else value.encode('utf-8')
+
+
+def getConfCacheFn(realPath):
+    """ The cache of a config file is also tied to the confSchema, since
+        the defaults and casts are applied from it.
+    """
+    schema = repr([(name, str(cast), default)
+                   for name, (cast, default, _) in confSchema.items()])
+    return os.path.join(CONF_CACHE_DIR, 'conf_%s.json' % hashlib.md5(
+        realPath + schema).hexdigest())
+
+
+def readConfFile(confFile):
+    """ Return the options in confFile as [(section, [(option, value), ...])],
+        as written (neither cast nor expanded), and whether they come from
+        the cache. The cache is kept in memory and in CONF_CACHE_DIR, and it
+        is valid while the file keeps its modification time or, if not, its
+        content.
+    """
+    realPath = os.path.realpath(confFile)
+    mtime = os.path.getmtime(confFile)
+    if parsedConfs.get(realPath, (None,))[0] == mtime:
+        return parsedConfs[realPath][1], True
+
+    cacheFn = getConfCacheFn(realPath)
+    try:
+        with open(cacheFn) as f:
+            cache = json.load(f)
+        cache['sections'] = [(_toStr(section), [(_toStr(opt), _toStr(value))
+                                                for opt, value in options])
+                             for section, options in cache['sections']]
+    except Exception:
+        cache = {}
+    if cache.get('mtime') == mtime:
+        parsedConfs[realPath] = (mtime, cache['sections'])
+        return cache['sections'], True
+
+    with open(confFile) as f:
+        content = f.read()
+    digest = hashlib.sha1(content).hexdigest()
+    cached = cache.get('hash') == digest
+    if cached:
+        sections = cache['sections']
+    else:
+        cp = SafeConfigParser()
+        cp.optionxform = str  # keep case (stackoverflow.com/questions/1611799)
+        cp.readfp(StringIO(content), confFile)
+        sections = [(section, cp.items(section)) for section in cp.sections()]
+
+    try:  # written apart and renamed to never leave a broken cache
+        pwutils.makePath(CONF_CACHE_DIR)
+        with open(cacheFn + '.tmp', 'w') as f:
+            json.dump({'mtime': mtime, 'hash': digest, 'sections': sections}, f)
+        os.rename(cacheFn + '.tmp', cacheFn)
+    except (IOError, OSError) as exc:
+        print("Config cache not saved: %s" % exc)
+    parsedConfs[realPath] = (mtime, sections)
+    return sections, cached
+
+
+def compileProfiles(sections, verbose=True):
+    """ Resolve all the microscope profiles of a config, given as
+        [(section, [(option, value), ...])], into an OrderedDict
+        {profileName: (confDict, errors)}.
+        The common sections (GLOBAL, FORM, MICROSCOPE, WORKFLOW...) make the
+        default profile (''), and each [MICROSCOPE:name] section makes the
+        'name' profile, inheriting from the default one.
+        Values are cast (and expanded) on every call, for the current user.
+    """
+    def castOptions(section, options, confDict, errors, origins):
+        if verbose:
+            print("\n - %s section - " % section)
+        for opt, value in options:
+            if verbose and opt in origins and origins[opt] != section:
+                print(pwutils.yellowStr("     %s in [%s] overwritten by [%s]"
+                                        % (opt, origins[opt], section)))
+            origins[opt] = section
+            # apply a certain casting
+            try:
+                newValue = castConf(opt, value)
+            except Exception as exc:
+                errors[opt] = "%s = %s (%s)" % (opt, value, exc)
+                confDict.pop(opt, None)
+                continue
+            if verbose:
+                print("     %s (%s): %s %s"
+                      % (opt, value, type(newValue), newValue))
+            errors.pop(opt, None)
+            confDict[opt] = newValue
+
+    # initialization of default parameters
+    confDict = {k: d for k, (c, d, isMandatory) in confSchema.items()
+                if not isMandatory}
+    errors = OrderedDict()
+    origins = {}
+    for section, options in sections:
+        if not section.startswith(PROFILE_PREFIX):
+            castOptions(section, options, confDict, errors, origins)
+    profiles = OrderedDict([('', (confDict, list(errors.values())))])
+
+    for section, options in sections:
+        if section.startswith(PROFILE_PREFIX):
+            profileDict = dict(confDict)
+            profileErrors = OrderedDict(errors)
+            # a profile may overwrite any common option on purpose
+            castOptions(section, options, profileDict, profileErrors, {})
+            profiles[section[len(PROFILE_PREFIX):].strip()] = (
+                profileDict, list(profileErrors.values()))
+    if verbose:
+        print('\n -------------------- \n')
+    return profiles
+
+
+def getProfileNames(confFile):
+    """ The microscope profiles in confFile, but the default one.
+    """
+    return [section[len(PROFILE_PREFIX):].strip()
+            for section, _ in readConfFile(confFile)[0]
+            if section.startswith(PROFILE_PREFIX)]
+
+
+def createDictFromConfig(confFile, profile=''):
+    """ Read the configuration from scipion/config/scipionbox.conf.
+     A dictionary will be created with the options of the profile: the ones
+     in the section MICROSCOPE:profile, all variables that are in the common
+     sections (GLOBAL, FORM, WORKFLOW...) will be inherited by default.
+     All the wrong or missing parameters are reported at once.
+    """
+    def fillConfPrint(missing=None, errors=None):
+        print(" > There is some problem reading '%s' config file.\n"
+              "Please fill a config file with:\n" % os.path.realpath(confFile))
+
+        mandatories = getMandatories()
+        print(" - *MANDATORY* parameters: " +
+              ', '.join(mandatories[0:-1]) + ' and ' + mandatories[-1] + '\n')
+
+        print(" - Optional parameters: Please see %s\n"
+              % os.path.abspath('scipionbox.template'))
+        if missing:
+            print("\n -> Missing: %s\n" % ', '.join(missing))
+        if errors:
+            print("\n -> Wrong values:\n      %s\n" % '\n      '.join(errors))
+        sys.exit(1)
+
+    # confFile = pw.getConfigPath("scipionbox.conf")
+    if not os.path.isfile(confFile):
+        fillConfPrint()
+
+    sections, cached = readConfFile(confFile)
+    print("\nReading conf file: %s%s" % (os.path.realpath(confFile),
+                                        ' (unchanged)' if cached else ''))
+    profiles = compileProfiles(sections, verbose=not cached)
+    if profile not in profiles:
+        print(pwutils.redStr(" > Microscope '%s' not found in '%s'. "
+                             "Available: %s" % (profile, confFile,
+                                                ', '.join(getProfileNames(
+                                                    confFile)) or 'none')))
+        sys.exit(1)
+    if profile:
+        print("Microscope profile: %s" % profile)
+
+    confDict, errors = profiles[profile]
+    missing = [var for var in getMandatories() if var not in confDict and
+               all(not error.startswith(var + ' =') for error in errors)]
+    if missing or errors:
+        fillConfPrint(missing, errors)
+
+    return dict(confDict)  # callers may change it
+
+
+def castConf(var, value):
+    """ Casting definitions for config parameters.
+    """
+    value = pwutils.expandPattern(value)
+
+    cast = confSchema.get(var, ('default',))[0]
+
+    if cast == 'splitTimesFloat':
+        if "*" in value:
+            newvar = reduce(lambda x, y: float(x) * float(y), value.split('*'))
+        elif "/" in value:
+            newvar = reduce(lambda x, y: float(x) / float(y), value.split('/'))
+        else:
+            newvar = float(value)
+    elif cast == bool:
+        try:
+            newvar = int(value) > 0
+        except:
+            newvar = False if value.lower() == 'false' else True
+    elif cast == 'path':
+        newvar = pwutils.expandPattern(value)
+    elif cast == 'default':
+        if value.lower() == 'true':
+            newvar = True
+        elif value.lower() == 'false':
+            newvar = False
+        else:
+            try:  # to transform to int: '-1'.isdigit() = False...
+                newvar = int(value)
+            except:
+                try:  # to transform to float (1.234, 1.32E-4...)
+                    newvar = float(value)
+                except ValueError:
+                    newvar = value
+    else:
+        newvar = cast(value)
+    return newvar
+
+
+def useNoTkinter():
+    """ Make pyworkflow import a dummy Tkinter, like in schedule_project.py
+    """
+    path = os.path.join(os.environ.get('SCIPION_HOME', ''),
+                        'pyworkflow', 'gui', 'no-tkinter')
+    sys.path.insert(1, path)
+
+
+def main(argv):
+    confFile = 'scipionbox.conf'
+    profile = ''
+    overrides = OrderedDict()
+    argv = list(argv)
+    while argv:
+        arg = argv.pop(0)
+        if arg == '--microscope' and argv:
+            profile = argv.pop(0)
+        elif '=' in arg:
+            key, value = arg.split('=', 1)
+            overrides[key.strip()] = value.strip()
+        else:
+            confFile = os.path.abspath(arg)
+
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    useNoTkinter()
+    confDict = createDictFromConfig(confFile, profile)
+
+    session = HeadlessSession(confDict, overrides)
+    errors = session.validate()
+    if errors:
+        errors.insert(0, "*Errors*:")
+        print(pwutils.redStr("\n  - ".join(errors)))
+        sys.exit(1)
+    if session.warnings:
+        print(pwutils.yellowStr("\n  - ".join(["*Warnings*:"] +
+                                               session.warnings)))
+
+    try:
+        session.createProject()
+    except Exception as exc:
+        print("\nSome error occurred while creating the project: \n !! %s !!"
+              % exc)
+        raise
+    print("\nProject %s created, but neither labelled nor scheduled. Run:\n"
+          "  scipion python set_labels_colors.py %s --headless\n"
+          "  scipion python schedule_project.py %s"
+          % ((session.getConfValue(PROJECT_NAME),) * 3))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -26,37 +26,80 @@
 # **************************************************************************
 """
 Launch main project window
+
+Usage: scipion python set_labels_colors.py PROJECT_NAME [--headless]
+
+  With --headless the project is loaded without any window (nor display),
+  to be used from scripts and daemons.
+
+  Only the labels not applied yet are set, so it can be run again after
+  adding protocols to the project.
 """
 import pickle
 
 import sys
 import os
+from collections import OrderedDict
 
 from pyworkflow.project import Manager, Label
-from pyworkflow.gui.project import ProjectWindow
 
+from project_utils import LabelStore, LABELS_FILE
 
-if __name__ == '__main__':
 
-    manager = Manager()
-    projName = os.path.basename(sys.argv[1])
-    projPath = manager.getProjectPath(projName)
+def loadLabels(proj):
+    """ Labels from the labels.pkl of the projects created before the
+        label store.
+    """
+    with open(proj.getPath('labels.pkl'), 'r') as f:
+        return pickle.load(f)
 
-    projWindow = ProjectWindow(projPath)
 
-    proj = projWindow.project
-    sett = proj.getSettings()
+def applyLabels(sett, labelsDict, colorsDict):
+    """ Add the new labels to the settings and set them to the protocol
+        nodes in a single pass, keeping the labels they already have. Nodes
+        not in the settings yet (the graph was never drawn) are created
+        without position, to be placed by the GUI.
+    """
     sett.setColorMode(sett.COLOR_MODE_LABELS)
-
-    with open(proj.getPath('labels.pkl'), 'r') as f:
-        labelsDict, colorsDict = pickle.load(f)
-
+    nodeLabels = OrderedDict()
     for labelName, prots in labelsDict.iteritems():
-        label = Label(name=labelName, color=colorsDict[labelName])
-        sett.getLabels().addLabel(label)
+        if sett.getLabels().getLabel(labelName) is None:
+            sett.getLabels().addLabel(Label(name=labelName,
+                                            color=colorsDict[labelName]))
         for protId in prots:
-            node = sett.getNodeById(protId)
-            node.setLabels([labelName])
+            nodeLabels.setdefault(protId, []).append(labelName)
+
+    for protId, labels in nodeLabels.iteritems():
+        node = sett.getNodeById(protId) or sett.addNode(protId)
+        oldLabels = [l for l in node.getLabels() if l not in labels]
+        node.setLabels(oldLabels + labels)
+
+
+if __name__ == '__main__':
+
+    projName = os.path.basename(sys.argv[1])
+
+    if '--headless' in sys.argv[2:]:
+        from schedule_project import loadProject
+        proj = loadProject(projName)
+    else:
+        from pyworkflow.gui.project import ProjectWindow
+        manager = Manager()
+        projPath = manager.getProjectPath(projName)
+        projWindow = ProjectWindow(projPath)
+        proj = projWindow.project
+
+    labelStore = None
+    if os.path.exists(proj.getPath(LABELS_FILE)):
+        labelStore = LabelStore(proj.getPath())
+        lastId, labelsDict, colorsDict = labelStore.getPending()
+    else:
+        labelsDict, colorsDict = loadLabels(proj)
 
+    applyLabels(proj.getSettings(), labelsDict, colorsDict)
     proj.saveSettings()
 
+    if labelStore is not None:
+        labelStore.setApplied(lastId)
+        labelStore.close()
+    print("%d protocols labeled." % sum(len(p) for p in labelsDict.values()))
@@ -5,73 +5,538 @@ This script will simply create symbolic links from files in an input
 folder. The links will be created in an output folder and every some
 time the last link will be 'touched' simulating an image that is being
 acquired by the microscope.
+
+Instead of a fixed delay, the original acquisition timing can be replayed
+(--replay) from the input files' modification times or from a manifest,
+compressed by a speed factor (--speed).
+
+Files are symlinked by default, but they can also be hard-linked, reflinked
+or copied (--transfer) to account for the real cost of moving the data,
+reporting the latency per file and the aggregated throughput at the end.
+With '--transfer write' the files are written by chunks at a given
+bandwidth (--write-rate), emulating the detector output, so the movies
+grow in the output folder while they are being 'acquired'.
+
+With '--synthetic N' no input data is needed: N noisy MRC movies with
+embedded particles are generated on the fly (INPUT_PATTERN is then used
+as the name template of the movies, i.e. 'movie_*.mrc').
+
+Several independent streams (i.e. several microscopes) can be simulated at
+once (--streams, --stream) from a pool of worker processes, each of them
+publishing into its own subfolder of OUTPUT_FOLDER.
+
+Linked and generated files are published atomically (created with a hidden
+temporary name and then renamed) and recorded in an append-only manifest
+(OUTPUT_FOLDER/.simulation_manifest), so an interrupted simulation can
+continue where it stopped (--resume). The manifest can also be replayed.
+
+Input files are enumerated lazily, folder by folder (i.e. GridSquare
+folders) in name or mtime order (--order), so huge datasets start to be
+published right away. The enumeration can be cached in an index file
+(--index) to start instantly in later runs.
 """
 
 import sys, os
 import time
-from glob import glob
+import argparse
+import fcntl
+import shutil
+import multiprocessing
+from fnmatch import fnmatchcase
+from glob import glob, has_magic
+
+try:
+    from os import scandir
+except ImportError:  # python < 3.5
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+import numpy as np
 
 import pyworkflow.utils as pwutils
 
 
+REPLAY_MTIME = 'mtime'
+
+ORDER_NAME = 'name'
+ORDER_MTIME = 'mtime'
+
+TRANSFER_LINK = 'link'
+TRANSFER_HARDLINK = 'hardlink'
+TRANSFER_REFLINK = 'reflink'
+TRANSFER_COPY = 'copy'
+TRANSFER_WRITE = 'write'
+TRANSFER_MODES = [TRANSFER_LINK, TRANSFER_HARDLINK, TRANSFER_REFLINK,
+                  TRANSFER_COPY, TRANSFER_WRITE]
+
+FICLONE = 0x40049409  # ioctl to clone a file (from linux/fs.h)
+
+MB = 1024 * 1024
+
+# MRC mode of every dtype allowed for the synthetic movies
+MRC_MODES = {'int8': 0, 'int16': 1, 'float32': 2, 'uint16': 6}
+MRC_HEADER_SIZE = 1024
+NOISE_BANK_SIZE = 4
+
+MANIFEST_NAME = '.simulation_manifest'
+TMP_SUFFIX = '.tmp'
+
+
 def usage(error):
     print("""
     ERROR: %s
-    
+
     Usage: simulate_acquisition.py INPUT_PATTERN OUTPUT_FOLDER TIME
         INPUT_PATTERN: input pattern matching input files.
         OUTPUT_FOLDER: where to create the output links.
         [GAIN_FILE]: gain file will be linked at beginning
         [DELAY, default 30]: delay in seconds between file appearance
+
+        Options:
+        --replay mtime|MANIFEST: replay the original inter-arrival times
+                                 taken from the input files' mtimes or from
+                                 a manifest file ('TIMESTAMP FILENAME' lines).
+        --speed FACTOR: time compression factor (i.e. 10 = ten times faster).
+        --max-gap SECONDS: cap for the original gaps (i.e. overnight breaks).
+        --transfer link|hardlink|reflink|copy|write: how files are
+                    published (default: link). 'reflink' falls back to an
+                    in-kernel copy (copy_file_range) or a buffered copy.
+        --write-rate MB/s: bandwidth of the 'write' transfer (0 = unlimited).
+        --chunk-size MB: size of every copied chunk (default: 16).
+        --fsync: sync every written chunk to disk.
+
+        --synthetic N: generate N movies instead of using the input files.
+        --size X Y: frame size of the synthetic movies (default: 4096 4096).
+        --frames N: number of frames per movie (default: 40).
+        --dtype int8|int16|uint16|float32: movies data type (default: int8).
+        --noise DOSE: mean counts per pixel and frame (default: 1.0).
+        --particles N: particles embedded per movie (default: 100).
+        --particle-size PX: particles diameter in pixels (default: 64).
+        --seed N: seed of the random generator.
+
+        --streams N: run N copies of the stream, in OUTPUT_FOLDER/stream_NN.
+        --stream PATTERN DELAY SUBFOLDER: add a stream with its own input
+                                          pattern, delay and output subfolder
+                                          (can be repeated).
+        --workers N: size of the workers pool (default: one per stream).
+
+        --resume: do not clean OUTPUT_FOLDER and continue after the last
+                  file recorded in its manifest.
+
+        --order name|mtime: order of the input files within every folder
+                            (default: name).
+        --index FILE: cache of the input files enumeration. It is read if
+                      it matches INPUT_PATTERN and --order, if not it is
+                      written (one per stream, suffixed by its subfolder).
     """ % error)
-    sys.exit(1)    
+    sys.exit(1)
 
 
-if not len(sys.argv) in (3,4,5):
-    usage("Incorrect number of input parameters")
+def parseArgs(argv):
+    """ Parse the command line keeping the legacy positional arguments,
+        where DELAY and GAIN_FILE can be given in any order.
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('inputPattern')
+    parser.add_argument('outputDir')
+    parser.add_argument('extra', nargs='*')
+    parser.add_argument('--replay', default=None)
+    parser.add_argument('--speed', type=float, default=1.)
+    parser.add_argument('--max-gap', dest='maxGap', type=float, default=None)
+    parser.add_argument('--transfer', choices=TRANSFER_MODES,
+                        default=TRANSFER_LINK)
+    parser.add_argument('--write-rate', dest='writeRate', type=float,
+                        default=0)
+    parser.add_argument('--chunk-size', dest='chunkSize', type=float,
+                        default=16)
+    parser.add_argument('--fsync', action='store_true')
+    parser.add_argument('--synthetic', type=int, default=0)
+    parser.add_argument('--size', type=int, nargs=2, default=[4096, 4096])
+    parser.add_argument('--frames', type=int, default=40)
+    parser.add_argument('--dtype', choices=sorted(MRC_MODES), default='int8')
+    parser.add_argument('--noise', type=float, default=1.)
+    parser.add_argument('--particles', type=int, default=100)
+    parser.add_argument('--particle-size', dest='particleSize', type=int,
+                        default=64)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--streams', type=int, default=1)
+    parser.add_argument('--stream', nargs=3, action='append', default=[])
+    parser.add_argument('--workers', type=int, default=0)
+    parser.add_argument('--resume', action='store_true')
+    parser.add_argument('--order', choices=[ORDER_NAME, ORDER_MTIME],
+                        default=ORDER_NAME)
+    parser.add_argument('--index', default=None)
 
-inputPattern = sys.argv[1]
-outputDir = sys.argv[2]
-gain = None
-delay = 30
-if len(sys.argv) == 4:
     try:
-        delay = int(sys.argv[3])
-        gain = None
-    except Exception:
-        gain = pwutils.expandPattern(sys.argv[3])
-        delay = 30
-elif len(sys.argv) == 5:
-    try:
-        delay = int(sys.argv[3])
-        gain = pwutils.expandPattern(sys.argv[4])
-    except Exception:
+        args = parser.parse_args(argv)
+    except SystemExit:
+        usage("Incorrect input parameters")
+
+    if len(args.extra) > 2:
+        usage("Incorrect number of input parameters")
+    if args.speed <= 0:
+        usage("--speed must be a positive number.")
+    if args.writeRate < 0 or args.chunkSize <= 0:
+        usage("--write-rate and --chunk-size must be positive numbers.")
+    if args.synthetic and args.replay == REPLAY_MTIME:
+        usage("Synthetic movies have no mtime to replay, use a manifest.")
+    if args.synthetic and (min(args.size) <= args.particleSize
+                           or args.frames < 1):
+        usage("Wrong size, frames or particle size for synthetic movies.")
+    if args.streams < 1 or args.workers < 0:
+        usage("--streams and --workers must be positive numbers.")
+    for stream in args.stream:
         try:
-            gain = pwutils.expandPattern(sys.argv[3])
-            delay = int(sys.argv[4])
-        except:
-            usage("DELAY must be an integer.")
+            stream[1] = float(stream[1])
+        except ValueError:
+            usage("Stream DELAY must be a number.")
+
+    args.gain = None
+    args.delay = 30
+    if len(args.extra) == 1:
+        try:
+            args.delay = int(args.extra[0])
+        except Exception:
+            args.gain = pwutils.expandPattern(args.extra[0])
+    elif len(args.extra) == 2:
+        try:
+            args.delay = int(args.extra[0])
+            args.gain = pwutils.expandPattern(args.extra[1])
+        except Exception:
+            try:
+                args.gain = pwutils.expandPattern(args.extra[0])
+                args.delay = int(args.extra[1])
+            except:
+                usage("DELAY must be an integer.")
+    return args
+
+
+def readManifest(manifestFn):
+    """ Read a manifest of recorded arrivals. Each line contains the arrival
+        timestamp (in seconds) and the file name, further columns and lines
+        starting by '#' are ignored.
+        Returns a dict {basename: timestamp}.
+    """
+    arrivals = {}
+    with open(manifestFn) as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            try:
+                arrivals[os.path.basename(fields[1])] = float(fields[0])
+            except (IndexError, ValueError):
+                print("Skipping malformed manifest line: %s" % line.strip())
+    return arrivals
+
+
+def _listDir(folder, partPattern, withMtime=False):
+    """ Yield (name, path, isDir, mtime) of the folder entries matching
+        partPattern. Only those are stat'ed, and their mtime is only read
+        if withMtime (0 otherwise).
+    """
+    def matches(name):
+        return (fnmatchcase(name, partPattern) and
+                (partPattern.startswith('.') or not name.startswith('.')))
+
+    if scandir is not None:
+        for entry in scandir(folder):
+            if matches(entry.name):
+                yield (entry.name, entry.path, entry.is_dir(),
+                       entry.stat().st_mtime if withMtime else 0)
+    else:
+        for name in os.listdir(folder):
+            if matches(name):
+                path = os.path.join(folder, name)
+                yield (name, path, os.path.isdir(path),
+                       os.path.getmtime(path) if withMtime else 0)
+
+
+def scanFiles(pattern, order=ORDER_NAME):
+    """ Lazy equivalent of glob(pattern): folders are walked one by one,
+        pruning the ones not matching the pattern, and their entries are
+        yielded sorted by name or mtime.
+    """
+    parts = pattern.split(os.sep)
+    depth0 = 0
+    while depth0 < len(parts) and not has_magic(parts[depth0]):
+        depth0 += 1
+    if depth0 == len(parts):  # no wildcards
+        if os.path.isfile(pattern):
+            yield pattern
+        return
+    root = os.sep.join(parts[:depth0])
+    if not root:
+        root = os.sep if pattern.startswith(os.sep) else os.curdir
+    sortKey = (lambda e: e[3]) if order == ORDER_MTIME else (lambda e: e[0])
+
+    def _walk(folder, depth):
+        partPattern = parts[depth]
+        isLast = depth == len(parts) - 1
+        try:
+            entries = list(_listDir(folder, partPattern,
+                                    order == ORDER_MTIME))
+        except OSError as e:
+            print("Skipping %s: %s" % (folder, e))
+            return
+        for name, path, isDir, _ in sorted(entries, key=sortKey):
+            if isLast:
+                if not isDir:
+                    yield path
+            elif isDir:
+                for fn in _walk(path, depth + 1):
+                    yield fn
+
+    for fn in _walk(root, depth0):
+        yield fn
+
+
+def iterInputFiles(pattern, order=ORDER_NAME, indexFn=None):
+    """ Yield the files matching pattern (see scanFiles). If an index file
+        is given, it is read when it matches the pattern and order, or it
+        is written while the files are yielded.
+    """
+    pattern = pwutils.expandPattern(pattern)
+    header = '# %s %s\n' % (order, pattern)
+
+    if indexFn is None:
+        for fn in scanFiles(pattern, order):
+            yield fn
+        return
+
+    if os.path.exists(indexFn):
+        with open(indexFn) as f:
+            if f.readline() == header:
+                print("Reading the input files from %s" % indexFn)
+                for line in f:
+                    yield line.rstrip('\n')
+                return
+        print("%s does not match the input pattern, indexing again."
+              % indexFn)
+
+    tmpFn = indexFn + TMP_SUFFIX
+    with open(tmpFn, 'w') as f:
+        f.write(header)
+        for fn in scanFiles(pattern, order):
+            f.write(fn + '\n')
+            yield fn
+    os.rename(tmpFn, indexFn)
+
+
+def getSchedule(inputFiles, delay, replay=None, maxGap=None):
+    """ Return the (file, offset) pairs, where offset is the number of
+        seconds (not yet scaled by the speed factor) since the first arrival.
+        With a fixed delay, it is a generator keeping the input laziness.
+    """
+    if replay is None:
+        return ((f, i * delay) for i, f in enumerate(inputFiles))
+
+    if replay == REPLAY_MTIME:
+        times = [(os.path.getmtime(f), f) for f in inputFiles]
+    else:
+        arrivals = readManifest(replay)
+        times = []
+        for f in inputFiles:
+            t = arrivals.get(os.path.basename(f))
+            if t is None:
+                print("Skipping %s: not found in the manifest." % f)
+            else:
+                times.append((t, f))
+    times.sort()
+
+    schedule = []
+    offset = 0
+    for i, (t, f) in enumerate(times):
+        if i > 0:
+            gap = t - times[i-1][0]
+            offset += gap if maxGap is None else min(gap, maxGap)
+        schedule.append((f, offset))
+    return schedule
+
+
+def getTmpPath(outputPath):
+    """ Hidden temporary name, not matching the acquisition pattern. """
+    folder, baseName = os.path.split(outputPath)
+    return os.path.join(folder, '.%s%s' % (baseName, TMP_SUFFIX))
+
+
+def cleanTmpFiles(outputDir):
+    """ Remove the temporary files left by an interrupted simulation. """
+    for fn in glob(os.path.join(outputDir, '.*%s' % TMP_SUFFIX)):
+        print("Removing unfinished file: %s" % fn)
+        pwutils.cleanPath(fn)
+
+
+class Manifest(object):
+    """ Append-only journal of the published files. Every line keeps the
+        publication time, the file name and its source, so it can be read
+        back by readManifest (to resume or to replay the simulation).
+    """
+    def __init__(self, outputDir):
+        self.path = os.path.join(outputDir, MANIFEST_NAME)
+        self._file = None
+
+    def getPublished(self):
+        return readManifest(self.path) if os.path.exists(self.path) else {}
+
+    def record(self, f):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write('%.3f\t%s\t%s\n'
+                         % (time.time(), os.path.basename(f), f))
+        self._file.flush()
+        os.fsync(self._file.fileno())
 
-inputFiles = glob(pwutils.expandPattern(inputPattern))
-inputFiles.sort()
-if gain is not None:
-    print("Gain path: ", gain)
-print("Input pattern: ", inputPattern)
-# print("Input files: ", inputFiles)
-print("Delay: ", str(delay), " seconds.")
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
 
-print("Cleaning output directory: ", outputDir)
-pwutils.cleanPath(outputDir)
-pwutils.makePath(outputDir)
 
-os.system("touch /tmp/scipion/simulation_%d" % (os.getpid()))
+def getSyntheticNames(template, n):
+    """ Names of the n synthetic movies. The template can contain a
+        '*' or a printf-like field to be replaced by the movie index.
+    """
+    template = os.path.basename(template)
+    if '%' not in template:
+        if '*' in template:
+            template = template.replace('*', '%05d', 1)
+        else:
+            template = '%s_%%05d.mrc' % os.path.splitext(template)[0]
+    return [template % (i + 1) for i in range(n)]
 
-aTime = int(delay)
-n = 5
-t = aTime / n
-# print("t=%s" % aTime)
 
-if gain is not None:
+def writeMrcHeader(f, shape, dtype, sampling=1.):
+    """ Write a minimal MRC2014 header for a stack of 'shape' (z, y, x). """
+    nz, ny, nx = shape
+    header = np.zeros(MRC_HEADER_SIZE // 4, dtype='<i4')
+    headerF = header.view('<f4')
+    header[0:3] = nx, ny, nz
+    header[3] = MRC_MODES[dtype]
+    header[7:10] = nx, ny, 1  # mx, my, mz: a stack of 2D images
+    headerF[10:13] = nx * sampling, ny * sampling, sampling
+    headerF[13:16] = 90.
+    header[16:19] = 1, 2, 3
+    headerF[19:22] = 0., -1., -2.  # dmax < dmin: stats not computed
+    headerF[54] = -1.
+    header[52] = np.frombuffer(b'MAP ', dtype='<i4')[0]
+    header[53] = np.frombuffer(b'DD\x00\x00', dtype='<i4')[0]
+    f.write(header.tobytes())
+
+
+class SyntheticMovies(object):
+    """ Generator of noisy movies with embedded particles.
+        Frames are combinations of a small bank of precomputed noise frames
+        and a per-movie particles image, so generating them costs little
+        more than writing them.
+    """
+    def __init__(self, size=(4096, 4096), frames=40, dtype='int8', noise=1.,
+                 particles=100, particleSize=64, seed=None):
+        self.nx, self.ny = size
+        self.frames = frames
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.particles = particles
+        self.rng = np.random.RandomState(seed)
+
+        self.noiseBank = self.rng.poisson(
+            noise, (NOISE_BANK_SIZE, self.ny, self.nx)).astype(self.dtype)
+
+        # Particles are a gaussian blob that absorbs half of the electrons
+        r = particleSize // 2
+        y, x = np.mgrid[-r:r, -r:r]
+        self.blob = (0.5 * np.exp(-(x ** 2 + y ** 2) / (0.5 * r ** 2))
+                     ).astype(np.float32)
+
+    def _getTransmission(self):
+        transmission = np.ones((self.ny, self.nx), dtype=np.float32)
+        by, bx = self.blob.shape
+        for _ in range(self.particles):
+            y0 = self.rng.randint(0, self.ny - by)
+            x0 = self.rng.randint(0, self.nx - bx)
+            transmission[y0:y0+by, x0:x0+bx] -= self.blob
+        return np.clip(transmission, 0, 1, out=transmission)
+
+    def _getNoiseFrame(self):
+        """ A view of a bank frame, randomly flipped to avoid repetitions. """
+        frame = self.noiseBank[self.rng.randint(NOISE_BANK_SIZE)]
+        flip = self.rng.randint(4)
+        if flip & 1:
+            frame = frame[::-1, :]
+        if flip & 2:
+            frame = frame[:, ::-1]
+        return frame
+
+    def write(self, path, writeRate=0):
+        """ Write a movie to path through a memory-mapped array.
+            If writeRate (MB/s) is given, frames are paced to that rate.
+        """
+        shape = (self.frames, self.ny, self.nx)
+        with open(path, 'wb') as f:
+            writeMrcHeader(f, shape, self.dtype.name)
+            f.truncate(MRC_HEADER_SIZE +
+                       self.frames * self.ny * self.nx * self.dtype.itemsize)
+
+        transmission = self._getTransmission()
+        movie = np.memmap(path, dtype=self.dtype, mode='r+',
+                          offset=MRC_HEADER_SIZE, shape=shape)
+        frameBytes = float(self.ny * self.nx * self.dtype.itemsize)
+        startTime = time.time()
+        for i in range(self.frames):
+            np.multiply(self._getNoiseFrame(), transmission, out=movie[i],
+                        casting='unsafe')
+            if writeRate > 0:
+                wait = (startTime + (i + 1) * frameBytes / (writeRate * MB)
+                        - time.time())
+                if wait > 0:
+                    time.sleep(wait)
+        movie.flush()
+        del movie
+
+    def publish(self, name, outputDir, writeRate=0, **kwargs):
+        """ Same interface than publishFile. """
+        outputPath = os.path.join(outputDir, os.path.basename(name))
+        tmpPath = getTmpPath(outputPath)
+        t0 = time.time()
+        self.write(tmpPath, writeRate)
+        os.rename(tmpPath, outputPath)
+        size = os.path.getsize(outputPath)
+        print("Generated %s (%.1f MB in %.2f s)"
+              % (outputPath, float(size) / MB, time.time() - t0))
+        return size
+
+
+class TransferStats(object):
+    """ Latency of every published file and the aggregated throughput. """
+    def __init__(self):
+        self.sizes = []
+        self.latencies = []
+        self.startTime = time.time()
+
+    def add(self, size, latency):
+        self.sizes.append(size)
+        self.latencies.append(latency)
+
+    def printReport(self, title=''):
+        if not self.latencies:
+            return
+        n = len(self.latencies)
+        totalMB = float(sum(self.sizes)) / MB
+        latencies = sorted(self.latencies)
+        busyTime = sum(latencies)
+        print("\n %s transfer stats:" % title)
+        print("   files: %d, %.1f MB" % (n, totalMB))
+        print("   latency (s): mean %.4f, median %.4f, p95 %.4f, max %.4f"
+              % (busyTime / n, latencies[n // 2],
+                 latencies[min(n - 1, int(0.95 * n))], latencies[-1]))
+        print("   throughput: %.1f MB/s while transferring, "
+              "%.1f MB/s overall\n"
+              % (totalMB / busyTime if busyTime else float('inf'),
+                 totalMB / (time.time() - self.startTime)))
+
+
+def linkGain(gain, outputDir):
     outputPath = os.path.join(outputDir, os.path.basename(gain))
     if not os.path.isdir(outputDir):
         print("Linking %s -> %s" % (outputPath, gain))
@@ -81,10 +546,254 @@ if gain is not None:
         except:
             print("No gain image found.")
 
-for f in inputFiles:
-    outputPath = os.path.join(outputDir, os.path.basename(f))
-    print("Linking %s -> %s" % (outputPath, f))
 
+def writeGrowingFile(src, dst, writeRate=0, chunkSize=16, fsync=False):
+    """ Copy src to dst by chunks of chunkSize MB at writeRate MB/s
+        (0 = as fast as possible). Every chunk is flushed, and optionally
+        synced, to make the file grow as a detector would do.
+        Returns the number of bytes written.
+    """
+    chunkBytes = int(chunkSize * MB)
+    startTime = time.time()
+    written = 0
+    with open(src, 'rb') as fIn:
+        with open(dst, 'wb') as fOut:
+            while True:
+                chunk = fIn.read(chunkBytes)
+                if not chunk:
+                    break
+                fOut.write(chunk)
+                fOut.flush()
+                if fsync:
+                    os.fsync(fOut.fileno())
+                written += len(chunk)
+                if writeRate > 0:
+                    wait = startTime + written / (writeRate * MB) - time.time()
+                    if wait > 0:
+                        time.sleep(wait)
+    return written
+
+
+def copyFile(src, dst, chunkSize=16):
+    """ Plain buffered copy. """
+    with open(src, 'rb') as fIn:
+        with open(dst, 'wb') as fOut:
+            shutil.copyfileobj(fIn, fOut, int(chunkSize * MB))
+
+
+def reflinkFile(src, dst, chunkSize=16):
+    """ Clone src sharing its data blocks (btrfs, xfs...). If the filesystem
+        does not support it, an in-kernel copy (copy_file_range) is tried
+        and, finally, a buffered copy.
+    """
+    with open(src, 'rb') as fIn:
+        with open(dst, 'wb') as fOut:
+            try:
+                fcntl.ioctl(fOut.fileno(), FICLONE, fIn.fileno())
+                return
+            except (IOError, OSError):
+                pass
+
+            if hasattr(os, 'copy_file_range'):  # python >= 3.8
+                size = os.fstat(fIn.fileno()).st_size
+                copied = 0
+                try:
+                    while copied < size:
+                        n = os.copy_file_range(fIn.fileno(), fOut.fileno(),
+                                               size - copied)
+                        if n == 0:
+                            break
+                        copied += n
+                    if copied == size:
+                        return
+                except OSError:
+                    pass
+                fIn.seek(0)
+                fOut.seek(0)
+                fOut.truncate()
+
+            shutil.copyfileobj(fIn, fOut, int(chunkSize * MB))
+
+
+def publishFile(f, outputDir, transfer=TRANSFER_LINK, writeRate=0,
+                chunkSize=16, fsync=False):
+    """ Publish f in outputDir and return its size. Links and copies are
+        created with a temporary name and renamed, while the 'write'
+        transfer grows the file in place.
+    """
+    outputPath = os.path.join(outputDir, os.path.basename(f))
     pwutils.cleanPath(outputPath)
-    pwutils.createLink(f, outputPath)
-    time.sleep(delay)
+    size = os.path.getsize(f)
+    t0 = time.time()
+
+    if transfer == TRANSFER_WRITE:
+        writeGrowingFile(f, outputPath, writeRate, chunkSize, fsync)
+    else:
+        tmpPath = getTmpPath(outputPath)
+        pwutils.cleanPath(tmpPath)
+        if transfer == TRANSFER_HARDLINK:
+            os.link(f, tmpPath)
+        elif transfer == TRANSFER_REFLINK:
+            reflinkFile(f, tmpPath, chunkSize)
+        elif transfer == TRANSFER_COPY:
+            copyFile(f, tmpPath, chunkSize)
+        else:
+            pwutils.createLink(f, tmpPath)
+        os.rename(tmpPath, outputPath)
+
+    print("%s %s -> %s (%.1f MB in %.3f s)"
+          % (transfer.capitalize(), f, outputPath, float(size) / MB,
+             time.time() - t0))
+    return size
+
+
+def simulate(schedule, outputDir, speed=1., publish=publishFile,
+             manifest=None, stats=None, **publishKwargs):
+    """ Publish every file of the schedule at its (scaled) offset.
+        Offsets are referred to the starting time, so the time spent
+        publishing does not accumulate as a drift.
+    """
+    startTime = time.time()
+    for f, offset in schedule:
+        wait = startTime + offset / speed - time.time()
+        if wait > 0:
+            time.sleep(wait)
+        t0 = time.time()
+        size = publish(f, outputDir, **publishKwargs)
+        if stats is not None:
+            stats.add(size, time.time() - t0)
+        if manifest is not None:
+            manifest.record(f)
+
+
+def skipPublished(schedule, published):
+    """ Yield the schedule entries not published yet, shifting them to
+        publish the first pending one right away.
+    """
+    firstOffset = None
+    for f, offset in schedule:
+        if os.path.basename(f) in published:
+            continue
+        if firstOffset is None:
+            firstOffset = offset
+        yield f, offset - firstOffset
+
+
+def getStreams(args):
+    """ Return a list of (inputPattern, delay, outputDir, seed) for every
+        stream to simulate. A single stream publishes in OUTPUT_FOLDER.
+    """
+    if args.streams == 1 and not args.stream:
+        return [(args.inputPattern, args.delay, args.outputDir, args.seed)]
+
+    streams = []
+    for i in range(args.streams):
+        seed = None if args.seed is None else args.seed + i
+        streams.append((args.inputPattern, args.delay,
+                        os.path.join(args.outputDir, 'stream_%02d' % (i + 1)),
+                        seed))
+    for pattern, delay, subFolder in args.stream:
+        streams.append((pattern, delay,
+                        os.path.join(args.outputDir, subFolder), args.seed))
+    return streams
+
+
+def runStream(args, inputPattern, delay, outputDir, seed=None):
+    """ Simulate the acquisition of a single stream. """
+    if args.synthetic:
+        inputFiles = getSyntheticNames(inputPattern, args.synthetic)
+        generator = SyntheticMovies(args.size, args.frames, args.dtype,
+                                    args.noise, args.particles,
+                                    args.particleSize, seed)
+        publish = generator.publish
+    else:
+        indexFn = args.index
+        if indexFn and outputDir != args.outputDir:
+            indexFn = '%s.%s' % (indexFn, os.path.basename(outputDir))
+        inputFiles = iterInputFiles(inputPattern, args.order, indexFn)
+        publish = publishFile
+
+    schedule = getSchedule(inputFiles, delay, args.replay, args.maxGap)
+
+    pwutils.makePath(outputDir)
+    manifest = Manifest(outputDir)
+    if args.resume:
+        cleanTmpFiles(outputDir)
+        published = manifest.getPublished()
+        schedule = skipPublished(schedule, published)
+        print("%s: resuming after %d published files."
+              % (outputDir, len(published)))
+
+    if isinstance(schedule, list) and schedule:
+        print("%s: %d files in %d seconds."
+              % (outputDir, len(schedule), schedule[-1][1] / args.speed))
+
+    stats = TransferStats()
+    try:
+        simulate(schedule, outputDir, args.speed, publish, manifest, stats,
+                 transfer=args.transfer,
+                 writeRate=args.writeRate, chunkSize=args.chunkSize,
+                 fsync=args.fsync)
+    finally:
+        manifest.close()
+        stats.printReport(outputDir)
+
+
+def _runStreamWorker(params):
+    """ Pool entry point, it must be a module function to be pickled. """
+    try:
+        runStream(*params)
+    except KeyboardInterrupt:
+        pass
+
+
+def main(argv):
+    args = parseArgs(argv)
+
+    if args.synthetic:
+        print("Synthetic movies: %d x (%d frames of %dx%d %s)"
+              % (args.synthetic, args.frames, args.size[0], args.size[1],
+                 args.dtype))
+    if args.gain is not None:
+        print("Gain path: ", args.gain)
+    print("Input pattern: ", args.inputPattern)
+    if args.replay is None:
+        print("Delay: ", str(args.delay), " seconds.")
+    else:
+        print("Replaying arrivals from: ", args.replay,
+              " (speed x%s)" % args.speed)
+    if args.transfer == TRANSFER_WRITE:
+        print("Writing at: ", (("%s MB/s" % args.writeRate)
+                               if args.writeRate else "full speed"),
+              " (chunks of %s MB%s)" % (args.chunkSize,
+                                         ", fsync" if args.fsync else ""))
+
+    streams = getStreams(args)
+
+    if not args.resume:
+        print("Cleaning output directory: ", args.outputDir)
+        pwutils.cleanPath(args.outputDir)
+    pwutils.makePath(args.outputDir)
+
+    if args.gain is not None:
+        linkGain(args.gain, args.outputDir)
+
+    if len(streams) == 1:
+        runStream(args, *streams[0])
+        return
+
+    workers = args.workers or len(streams)
+    print("Running %d streams with %d workers." % (len(streams), workers))
+    pool = multiprocessing.Pool(workers)
+    try:
+        # a timeout in get() keeps the main process responsive to Ctrl-C
+        pool.map_async(_runStreamWorker,
+                       [(args,) + stream for stream in streams]).get(1e9)
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+    pool.join()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:     em-facilities contributors (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+"""
+Handle of the acquisition simulations launched by the session form.
+
+Every simulation runs in its own process group, under a small process that
+writes its output in a rotated log, and it is registered in SIM_DIR until
+it is stopped. The form stops it if the window is closed without creating
+the session, and the session stops it when it ends (see wizard.sh).
+
+A simulation belongs to the process in the SCIPION_SESSION_PID environment
+variable (i.e. the wizard.sh shell) or, if not set, to itself (i.e. from the
+headless session_launcher.py, that exits once the project is created), so it
+is only stopped by its PID or by a new simulation in the same folder.
+
+Usage: scipion python simulation_process.py status
+       scipion python simulation_process.py stop [PID ...]
+       scipion python simulation_process.py stop --owner PID
+       scipion python simulation_process.py stop --runaway
+
+  --owner stops the simulations of a session, and --runaway the ones whose
+  session is gone.
+"""
+
+import os
+import sys
+import errno
+import json
+import time
+import signal
+import logging
+import subprocess
+from logging.handlers import RotatingFileHandler
+
+SIM_DIR = '/tmp/scipion/simulations'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 3
+STOP_TIMEOUT = 10  # seconds between SIGTERM and SIGKILL
+SESSION_ENV = 'SCIPION_SESSION_PID'
+
+
+def getSessionOwner(default=None):
+    owner = os.environ.get(SESSION_ENV)
+    return default if owner is None else int(owner)
+
+
+def isAlive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as exc:
+        return exc.errno == errno.EPERM  # alive, but from another user
+    return True
+
+
+def runLogged(logFn, cmd):
+    """ Run cmd writing its output, line by line, in a log rotated every
+        LOG_MAX_BYTES. Used as the main process of every simulation.
+    """
+    handler = RotatingFileHandler(logFn, maxBytes=LOG_MAX_BYTES,
+                                  backupCount=LOG_BACKUPS)
+    handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+    logger = logging.getLogger('simulation')
+    logger.propagate = False
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    env = dict(os.environ, PYTHONUNBUFFERED='1')  # lines as soon as printed
+    child = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, env=env)
+    for line in iter(child.stdout.readline, b''):
+        logger.info(line.rstrip('\n'))
+    returnCode = child.wait()
+    logger.info("Simulation finished (exit code %d)." % returnCode)
+    return returnCode
+
+
+class SimulationProcess(object):
+    """ A simulation registered in SIM_DIR. Its pid is the one of its
+        process group, so stop() also reaches the Scipion wrapper, the
+        simulator and its stream workers.
+
+        Usage:
+            sim = SimulationProcess.start(cmd, logFn)
+            print(sim.getStatus())
+            sim.stop()
+    """
+    def __init__(self, pid, info=None, popen=None):
+        self.pid = pid
+        self.info = info or {}
+        self._popen = popen  # only if started by this process
+
+    @classmethod
+    def start(cls, cmd, logFn, outputDir=None):
+        if not os.path.isdir(SIM_DIR):
+            os.makedirs(SIM_DIR)
+        devNull = open(os.devnull, 'r+')
+        popen = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  'run', logFn] + cmd,
+                                 stdin=devNull, stdout=devNull, stderr=devNull,
+                                 close_fds=True, preexec_fn=os.setsid)
+        devNull.close()
+        sim = cls(popen.pid, {'cmd': cmd, 'log': logFn, 'start': time.time(),
+                              'owner': getSessionOwner(popen.pid),
+                              'outputDir': outputDir}, popen)
+        with open(sim.getStateFile(), 'w') as f:
+            json.dump(sim.info, f)
+        return sim
+
+    @classmethod
+    def load(cls, pid):
+        with open(os.path.join(SIM_DIR, '%d.json' % pid)) as f:
+            return cls(pid, json.load(f))
+
+    def getStateFile(self):
+        return os.path.join(SIM_DIR, '%d.json' % self.pid)
+
+    def isRunning(self):
+        if self._popen is not None:
+            return self._popen.poll() is None
+        try:  # the pid may have been reused since the simulation ended
+            with open('/proc/%d/cmdline' % self.pid) as f:
+                return os.path.basename(__file__).rstrip('c') in f.read()
+        except IOError:
+            return False
+
+    def getStatus(self):
+        status = dict(self.info, pid=self.pid, running=self.isRunning(),
+                      uptime=time.time() - self.info.get('start', time.time()),
+                      lastLine='')
+        try:
+            with open(self.info['log']) as f:
+                f.seek(max(0, os.path.getsize(self.info['log']) - 4096))
+                lines = f.read().splitlines()
+                status['lastLine'] = lines[-1] if lines else ''
+        except (KeyError, IOError, OSError):
+            pass
+        return status
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """ Terminate the whole process group (killed if it does not finish
+            within timeout seconds) and unregister it.
+            Return whether it was running.
+        """
+        wasRunning = self.isRunning()
+        if wasRunning:
+            self._signal(signal.SIGTERM)
+            deadline = time.time() + timeout
+            while self.isRunning() and time.time() < deadline:
+                time.sleep(0.2)
+            if self.isRunning():
+                self._signal(signal.SIGKILL)
+        if self._popen is not None:
+            self._popen.wait()
+        if os.path.exists(self.getStateFile()):
+            os.remove(self.getStateFile())
+        return wasRunning
+
+    def _signal(self, sig):
+        try:
+            os.killpg(self.pid, sig)
+        except OSError:  # already finished
+            pass
+
+
+def getSimulations():
+    """ All the simulations registered, running or not. """
+    if not os.path.isdir(SIM_DIR):
+        return []
+    sims = []
+    for fn in sorted(os.listdir(SIM_DIR)):
+        if fn.endswith('.json'):
+            try:
+                sims.append(SimulationProcess.load(int(fn[:-5])))
+            except (ValueError, IOError):
+                pass
+    return sims
+
+
+def stopSimulations(select):
+    """ Stop the simulations for which select(sim) is True. """
+    for sim in getSimulations():
+        if select(sim) and sim.stop():
+            print("Simulation %d stopped (log in %s)."
+                  % (sim.pid, sim.info.get('log')))
+
+
+def stopRunaways(outputDir=None):
+    """ Stop the simulations left behind by sessions already finished, and
+        any other writing in outputDir.
+    """
+    def isRunaway(sim):
+        owner = sim.info.get('owner')
+        return ((owner is None or not isAlive(owner)) or
+                (outputDir is not None and sim.info.get('outputDir') and
+                 os.path.realpath(sim.info['outputDir']) ==
+                 os.path.realpath(outputDir)))
+    stopSimulations(isRunaway)
+
+
+def printStatus():
+    sims = getSimulations()
+    if not sims:
+        print("No simulation registered.")
+    for sim in sims:
+        status = sim.getStatus()
+        print("%d %s, up %d s, log: %s\n    %s"
+              % (status['pid'], 'RUNNING' if status['running'] else 'finished',
+                 status['uptime'], status.get('log'), status['lastLine']))
+
+
+def main(argv):
+    if argv and argv[0] == 'run':
+        sys.exit(runLogged(argv[1], argv[2:]))
+    elif argv and argv[0] == 'status':
+        printStatus()
+    elif argv[:2] == ['stop', '--owner'] and len(argv) == 3:
+        stopSimulations(lambda sim: sim.info.get('owner') == int(argv[2]))
+    elif argv == ['stop', '--runaway']:
+        stopRunaways()
+    elif argv and argv[0] == 'stop' and len(argv) > 1:
+        pids = [int(pid) for pid in argv[1:]]
+        stopSimulations(lambda sim: sim.pid in pids)
+    else:
+        print(__doc__)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# **************************************************************************
+# *
+# * Authors:     em-facilities contributors (scipion@cnb.csic.es)
+# *
+# * Unidad de  Bioinformatica of Centro Nacional de Biotecnologia , CSIC
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 2 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import sys
+import time
+import argparse
+
+import pyworkflow.utils as pwutils
+from pyworkflow.object import Set
+from pyworkflow.protocol.constants import MODE_RESUME
+
+from schedule_project import (loadProject, getDependencies, matchesAny,
+                              getOutputSizes, PriorityThrottle)
+
+
+def usage(error):
+    print("""
+    ERROR: %s
+
+    Usage: scipion python supervise_project.py PROJECT_NAME
+                    [--poll SECONDS] [--stall N] [--retries N]
+                    [--backoff SECONDS] [--max-backoff SECONDS]
+                    [--exclude PATTERN1 PATTERN2 ...] [--throttle BACKLOG]
+
+        Watch the streaming protocols of a running project and relaunch
+          (in resume mode) the ones that fail or get stuck.
+
+        A protocol is stuck when its inputs keep growing but its outputs
+          (and steps done) do not change for --stall polls in a row, once it
+          has produced some output (i.e. triggers wait for a whole batch).
+          Protocols without any parent in the project (i.e. the import)
+          are only relaunched if they fail.
+
+        The n-th relaunch of a protocol waits backoff*2^(n-1) seconds
+          (up to --max-backoff) and a protocol is given up after --retries.
+
+        With --throttle, the running protocols of the lower priority classes
+          are stopped while the preprocessing backlog is above BACKLOG
+          (3D first, then 2D and picking at 2 and 3 times BACKLOG) and
+          resumed when it catches up, like in schedule_project.py.
+
+        The --exclude patterns are matched against the class name and the
+          label of the protocols, like in schedule_project.py.
+    """ % error)
+    sys.exit(1)
+
+
+def isStreaming(prot):
+    worksInStreaming = getattr(prot, 'worksInStreaming', None)
+    if worksInStreaming is not None and worksInStreaming():
+        return True
+    return any(output.isStreamOpen()
+               for _, output in prot.iterOutputAttributes(Set))
+
+
+def getProgress(prot):
+    """ A cheap signature of the work done by prot: the size of its output
+        sets (from the project database, no set is opened) and its steps done.
+    """
+    sizes = tuple(sorted(getOutputSizes(prot).items()))
+    stepsDone = getattr(prot, '_stepsDone', None)
+    return sizes, stepsDone.get() if stepsDone is not None else None
+
+
+class Supervisor(object):
+    """ Poll the runs of a project and relaunch the failed or stuck streaming
+        protocols with an exponential backoff and a retry cap. With a
+        throttle, the protocols of the paused priority classes are stopped
+        and resumed later.
+    """
+    def __init__(self, project, poll=60, stall=5, retries=3,
+                 backoff=60, maxBackoff=3600, exclude=(), throttle=None):
+        self.project = project
+        self.poll = poll
+        self.stall = stall
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.exclude = exclude
+        self.throttle = throttle
+        self.paused = set()
+        self.iteration = 0
+        self.progress = {}    # protId: (signature, iteration of last change)
+        self.attempts = {}    # protId: relaunches done
+        self.nextAttempt = {}  # protId: time for the next relaunch
+        self.givenUp = set()
+
+    def _updateProgress(self, prot):
+        signature = getProgress(prot)
+        last = self.progress.get(prot.getObjId())
+        if last is None or last[0] != signature:
+            self.progress[prot.getObjId()] = (signature, self.iteration)
+
+    def _lastChange(self, protId):
+        return self.progress.get(protId, (None, self.iteration))[1]
+
+    def _isStuck(self, prot, parents):
+        if not parents or not prot.isActive():
+            return False
+        # triggers and batch protocols wait for N inputs without any output
+        if not any(getOutputSizes(prot).values()):
+            return False
+        lastChange = self._lastChange(prot.getObjId())
+        inputsGrew = any(self._lastChange(p) > lastChange for p in parents)
+        return inputsGrew and self.iteration - lastChange >= self.stall
+
+    def _relaunch(self, prot, reason):
+        protId = prot.getObjId()
+        attempt = self.attempts.get(protId, 0)
+        if attempt >= self.retries:
+            self.givenUp.add(protId)
+            print(pwutils.redStr("Giving up with %s (%s) after %d relaunches."
+                                 % (prot.getObjLabel(), reason, attempt)))
+            return
+
+        now = time.time()
+        if protId not in self.nextAttempt:
+            delay = min(self.backoff * 2 ** attempt, self.maxBackoff)
+            self.nextAttempt[protId] = now + delay
+            print(pwutils.yellowStr("%s %s, relaunching it in %d s (%d/%d)."
+                                    % (prot.getObjLabel(), reason, delay,
+                                       attempt + 1, self.retries)))
+        if now < self.nextAttempt[protId]:
+            return
+
+        if prot.isActive():
+            self.project.stopProtocol(prot)
+        self._resume(prot)
+        del self.nextAttempt[protId]
+        self.attempts[protId] = attempt + 1
+        print(pwutils.greenStr("%s relaunched." % prot.getObjLabel()))
+
+    def _resume(self, prot):
+        prot.runMode.set(MODE_RESUME)
+        self.project.launchProtocol(prot)
+        # give it a fresh stall window
+        self.progress[prot.getObjId()] = (getProgress(prot), self.iteration)
+
+    def _throttle(self, runs):
+        self.throttle.update(runs)
+        for prot in runs:
+            protId = prot.getObjId()
+            if self.throttle.isPaused(prot):
+                if prot.isActive() and protId not in self.nextAttempt:
+                    self.project.stopProtocol(prot)
+                    self.paused.add(protId)
+                    print("%s paused." % prot.getObjLabel())
+            elif protId in self.paused:
+                self.paused.remove(protId)
+                self._resume(prot)
+                print("%s resumed." % prot.getObjLabel())
+
+    def check(self):
+        """ One poll: return whether something is still running or waiting
+            to be relaunched.
+        """
+        self.iteration += 1
+        runs = [prot for prot in self.project.getRuns(refresh=True)
+                if not matchesAny(prot, self.exclude)]
+        dependencies = getDependencies(runs)
+        for prot in runs:
+            self._updateProgress(prot)
+        if self.throttle is not None:
+            self._throttle(runs)
+
+        busy = bool(self.paused)
+        for prot in runs:
+            protId = prot.getObjId()
+            if (protId in self.givenUp or protId in self.paused or
+                    not isStreaming(prot)):
+                continue
+            if prot.isFailed():
+                self._relaunch(prot, "failed")
+            elif self._isStuck(prot, dependencies[protId]):
+                self._relaunch(prot, "is stuck")
+            elif protId in self.nextAttempt:  # recovered before relaunched
+                del self.nextAttempt[protId]
+                print("%s recovered." % prot.getObjLabel())
+            busy = busy or prot.isActive() or protId in self.nextAttempt
+        return busy
+
+    def run(self):
+        while self.check():
+            time.sleep(self.poll)
+        print("No streaming protocol running, supervision finished.")
+
+
+def parseArgs(argv):
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('projName')
+    parser.add_argument('--poll', type=float, default=60)
+    parser.add_argument('--stall', type=int, default=5)
+    parser.add_argument('--retries', type=int, default=3)
+    parser.add_argument('--backoff', type=float, default=60)
+    parser.add_argument('--max-backoff', dest='maxBackoff', type=float,
+                        default=3600)
+    parser.add_argument('--exclude', nargs='*', default=[])
+    parser.add_argument('--throttle', type=int, default=0)
+    try:
+        return parser.parse_args(argv)
+    except SystemExit:
+        usage("This script accepts 1 mandatory parameter: the project name.")
+
+
+if __name__ == '__main__':
+    args = parseArgs(sys.argv[1:])
+
+    project = loadProject(args.projName)
+
+    throttle = PriorityThrottle(args.throttle) if args.throttle else None
+    Supervisor(project, args.poll, args.stall, args.retries, args.backoff,
+               args.maxBackoff, args.exclude, throttle).run()
@@ -11,7 +11,6 @@ tokenDir=/tmp/scipion
 scriptFolder=$emfacilities/usingAPI_demo
 launcherScript=$scriptFolder/form_launcher.py
 tokenPattern=$tokenDir/project_*  # must coincide with the token made by the form_launcher.py
-simPattern=$tokenDir/simulation_* # must coincide with the token made by the simulate_acquitition.py
 
 function runJob(){
   echo
@@ -30,6 +29,7 @@ rm $tokenPattern 2>/dev/null
 
 # Launch the acquisition form and start the simulation
 export ScipionProjectName=$(date +%Y%m%d)_mySelf_myProtein
+export SCIPION_SESSION_PID=$$  # owner of the simulation (see simulation_process.py)
 $preCommands &
 runJob $scipionBin python $launcherScript
 
@@ -56,9 +56,5 @@ then
   runJob $scipionWrapper $scipionBin project $project
 fi
 
-# Getting simulation's pid to kill it
-ls $simPattern >>/dev/null 2>/dev/null &&
-pidToken=$(ls $simPattern) &&
-echo "Stopping the simulation..." &&
-kill -9 "${pidToken#*_}" &&
-rm $pidToken
+# Stopping the simulation of this session, if any (see simulation_process.py)
+runJob $scipionBin python $scriptFolder/simulation_process.py stop --owner $$